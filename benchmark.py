@@ -0,0 +1,75 @@
+__doc__ = '''
+Замер скорости загрузки книг издательства без обращения к сайтам.
+
+Сначала ответы сайта записываются во время обычного запуска:
+    python benchmark.py record bebc.co.uk "Oxford University Press"
+затем тот же сбор повторяется по записи с заданной задержкой ответа:
+    python benchmark.py replay bebc.co.uk "Oxford University Press" --latency 0.05
+'''
+
+import argparse
+import time
+
+import exporters
+import files
+import images
+import web
+from http_replay import MODE_RECORD, MODE_REPLAY
+from logger_manager import create_logger
+from shops import bebc, my_shop, studentsbook
+
+
+def create_books_thread(shop: str, publisher: str):
+    """Создаёт поток загрузки книг так же, как это делает главное окно."""
+    files.prepare_output_dirs_and_files(shop, publisher)
+    paths = (files.get_excel_filepath(shop, publisher), files.get_images_dirpath(shop, publisher),
+             files.get_missing_images_dirpath(shop, publisher))
+
+    if shop == bebc.SHOP:
+        return bebc.BebcBooks(publisher, *paths)
+    elif shop == my_shop.SHOP:
+        publishers = dict(p.split("\tID=") for p in files.read_publishers(shop) if "\tID=" in p)
+        return my_shop.MyShopBooks(publisher, *paths, publishers[publisher], publisher, [])
+    elif shop == studentsbook.SHOP:
+        sb = studentsbook.StudentsbookPublishers()
+        sb.parse_xml_file()
+        sb.get_total_offers()
+        sb.get_total_categories()
+        return studentsbook.StudentsbookBooks(publisher, *paths, sb.feed)
+    raise ValueError(f"Неизвестный магазин {shop}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=[MODE_RECORD, MODE_REPLAY])
+    parser.add_argument('shop', choices=[bebc.SHOP, my_shop.SHOP, studentsbook.SHOP])
+    parser.add_argument('publisher')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='задержка ответа при воспроизведении, с (по умолчанию — как при записи)')
+    parser.add_argument('--formats', nargs='+', choices=list(exporters.EXPORTERS),
+                        default=list(exporters.DEFAULT_EXPORT_FORMATS), help='форматы выгрузки книг')
+    args = parser.parse_args()
+
+    logger = create_logger(None, "logs.txt")
+    web.logger = logger
+    web.configure_http_mode(args.mode, files.get_fixtures_dirpath(args.shop), args.latency)
+    exporters.enable_catalog(files.get_catalog_filepath())
+
+    books_thread = create_books_thread(args.shop, args.publisher)
+    books_thread.EXPORT_FORMATS = args.formats
+    results, errors = [], []
+    books_thread.result.connect(results.append)
+    books_thread.error.connect(errors.append)
+
+    start = time.perf_counter()
+    books_thread.run()  # в текущем потоке, без цикла событий Qt
+    images.close_image_processor()
+    time_diff = time.perf_counter() - start
+
+    books_count = results[0]['books_count'] if results else 0
+    logger.debug(f"[{args.mode}] {args.shop} '{args.publisher}': {books_count} книг за {time_diff:.2f} секунд"
+                 + (f", ошибка: {errors[0]}" if errors else ""))
+
+
+if __name__ == '__main__':
+    main()
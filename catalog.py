@@ -0,0 +1,140 @@
+__doc__ = '\nЛокальный каталог собранных книг в базе SQLite.\n'
+
+import json
+import os
+import sqlite3
+import threading
+
+import files
+
+# Значения-заглушки, которые шопы подставляют вместо отсутствующих данных
+EMPTY_VALUES = ('', ' ', 'None')
+FETCH_SIZE = 500
+
+
+def make_product_key(product_id: str, isbn: str, name: str) -> str:
+    """Ключ книги внутри магазина: ID товара, а если его нет — ISBN, а если нет и его — название."""
+    if product_id not in EMPTY_VALUES:
+        return f'id:{product_id}'
+    if isbn not in EMPTY_VALUES:
+        return f'isbn:{isbn}'
+    return f'name:{name}'
+
+
+class BooksCatalog:
+    __doc__ = '''
+    Каталог книг всех магазинов: строка таблицы (см. files.BOOK_COLUMNS)
+    на книгу, ключ — магазин и ID товара или ISBN. Повторный сбор обновляет
+    существующие записи, поэтому каталог копит книги между запусками.
+    Книги последнего сбора издательства возвращает iter_rows с seen_since.
+    '''
+
+    def __init__(self, db_filepath: str):
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_filepath), exist_ok=True)
+        self._connection = sqlite3.connect(db_filepath, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS books (
+                shop TEXT NOT NULL,
+                product_key TEXT NOT NULL,
+                publisher TEXT NOT NULL,
+                product_id TEXT,
+                isbn TEXT,
+                name TEXT,
+                price REAL,
+                row TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                first_seen_at REAL NOT NULL,
+                seen_at REAL NOT NULL,
+                PRIMARY KEY (shop, product_key)
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS books_publisher ON books (shop, publisher, seen_at)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS books_isbn ON books (isbn)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS books_product_id ON books (shop, product_id)')
+
+    def upsert_rows(self, shop: str, publisher: str, rows: list, seen_at: float, start_position=0) -> None:
+        """
+        Добавляет или обновляет строки книг издательства одной транзакцией.
+        seen_at — метка сбора, position — порядковый номер книги в сборе.
+        """
+        records = []
+        for position, row in enumerate(rows, start_position):
+            product_id = str(row[files.ID_COLUMN - 1])
+            isbn = str(row[files.ISBN_COLUMN - 1])
+            name = str(row[files.NAME_COLUMN - 1])
+            price = row[files.PRICE_COLUMN - 1]
+            records.append((
+                shop, make_product_key(product_id, isbn, name), publisher,
+                None if product_id in EMPTY_VALUES else product_id,
+                None if isbn in EMPTY_VALUES else isbn, name,
+                price if isinstance(price, (int, float)) else None,
+                json.dumps(row, ensure_ascii=False, default=str), position, seen_at, seen_at))
+
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany('''
+                    INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (shop, product_key) DO UPDATE SET
+                        publisher = excluded.publisher, product_id = excluded.product_id,
+                        isbn = excluded.isbn, name = excluded.name, price = excluded.price,
+                        row = excluded.row, position = excluded.position, seen_at = excluded.seen_at''',
+                    records)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def iter_rows(self, shop: str, publisher: str, seen_since=None):
+        """
+        Строки книг издательства в порядке сбора.
+        seen_since — только книги, встреченные начиная с этой метки (например, в последнем сборе).
+        """
+        query = 'SELECT row FROM books WHERE shop = ? AND publisher = ?'
+        params = [shop, publisher]
+        if seen_since is not None:
+            query += ' AND seen_at >= ?'
+            params.append(seen_since)
+        query += ' ORDER BY seen_at, position'
+        with self._lock:
+            cursor = self._connection.execute(query, params)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield json.loads(row['row'])
+        finally:
+            cursor.close()
+
+    def find_books(self, isbn=None, product_id=None, shop=None) -> list:
+        """Ищет книги по ISBN и/или ID товара во всех издательствах (или в магазине shop)."""
+        conditions, params = [], []
+        for column, value in (('isbn', isbn), ('product_id', product_id), ('shop', shop)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(str(value))
+        query = 'SELECT shop, publisher, row, seen_at FROM books'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            return [{'shop': book['shop'], 'publisher': book['publisher'],
+                     'row': json.loads(book['row']), 'seen_at': book['seen_at']}
+                    for book in self._connection.execute(query, params)]
+
+    def get_publishers_report(self, shop: str) -> list:
+        """Сводка по издательствам магазина: число книг, число книг с ценой, дата последнего сбора."""
+        with self._lock:
+            return [dict(report) for report in self._connection.execute('''
+                SELECT publisher, COUNT(*) AS books_count, COUNT(price) AS priced_count,
+                       MAX(seen_at) AS last_seen_at
+                FROM books WHERE shop = ? GROUP BY publisher ORDER BY publisher''', (shop,))]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,174 @@
+__doc__ = '\nОбщее хранилище картинок обложек, адресуемое по содержимому.\n'
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+import uuid
+from contextlib import suppress
+
+import files
+import web
+
+# Через сколько секунд картинку по уже известному адресу стоит скачать заново
+URL_TTL = 30 * 24 * 60 * 60
+HASH_CHUNK_SIZE = 1024 * 1024
+# Через сколько секунд недокачанная картинка во временном каталоге считается брошенной
+TMP_MAX_AGE = 7 * 24 * 60 * 60
+DOWNLOAD_LOCKS_COUNT = 64
+READ_ONLY_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+cover_store = None
+cover_store_lock = threading.Lock()
+
+
+class CoverStore:
+    __doc__ = '''
+    Хранилище обложек всех магазинов и издательств: каждая картинка лежит
+    один раз в файле blobs/<первые 2 символа хэша>/<sha256 содержимого>,
+    а база index.sqlite3 помнит, какой хэш скачан по какому адресу.
+    Повторный адрес (например, общая картинка «нет обложки») не скачивается,
+    а одинаковые картинки с разных адресов хранятся одним файлом.
+    В каталоги издательств картинки попадают жёсткими ссылками (link_cover),
+    поэтому на диске каждая картинка одна. Файлы хранилища только для чтения,
+    чтобы правка картинки в каталоге издательства не изменила её во всех остальных.
+    Недокачанная картинка лежит в tmp под именем из хэша адреса и докачивается
+    при следующей загрузке того же адреса, в том числе в следующем запуске.
+    '''
+
+    def __init__(self, dirpath: str, url_ttl=URL_TTL):
+        self.dirpath = dirpath
+        self.url_ttl = url_ttl
+        self.blobs_dirpath = os.path.join(dirpath, 'blobs')
+        self.tmp_dirpath = os.path.join(dirpath, 'tmp')
+        os.makedirs(self.blobs_dirpath, exist_ok=True)
+        os.makedirs(self.tmp_dirpath, exist_ok=True)
+        self.remove_stale_tmp_files()
+        self._lock = threading.Lock()
+        # Один адрес не скачивается одновременно в двух потоках: у загрузок общий временный файл
+        self._download_locks = [threading.Lock() for _ in range(DOWNLOAD_LOCKS_COUNT)]
+
+        self._connection = sqlite3.connect(os.path.join(dirpath, 'index.sqlite3'),
+                                           check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL
+            )''')
+
+    def get_blob_filepath(self, digest: str) -> str:
+        """Путь к файлу картинки с заданным хэшем."""
+        return os.path.join(self.blobs_dirpath, digest[:2], digest)
+
+    def get_derived_filepath(self, blob_filepath: str, kind: str) -> str:
+        """Путь к производной от картинки (например, переведённой в JPEG или уменьшенной)."""
+        digest = os.path.basename(blob_filepath)
+        return os.path.join(self.dirpath, 'derived', kind, digest[:2], digest)
+
+    def find(self, url: str):
+        """Путь к уже скачанной по адресу url картинке или None."""
+        with self._lock:
+            entry = self._connection.execute('SELECT digest, stored_at FROM urls WHERE url = ?', (url,)).fetchone()
+        if entry is None or time.time() - entry[1] > self.url_ttl:
+            return None
+        blob_filepath = self.get_blob_filepath(entry[0])
+        return blob_filepath if os.path.exists(blob_filepath) else None
+
+    def fetch(self, url: str, session=None) -> str:
+        """Возвращает путь к картинке по адресу url, скачивая её, только если адрес ещё не встречался."""
+        blob_filepath = self.find(url)
+        if blob_filepath:
+            return blob_filepath
+
+        url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        with self._download_locks[int(url_digest, 16) % DOWNLOAD_LOCKS_COUNT]:
+            # Пока ждали, картинку мог скачать другой поток
+            blob_filepath = self.find(url)
+            if blob_filepath:
+                return blob_filepath
+
+            # При ошибке .part остаётся в tmp и докачивается следующей загрузкой этого адреса
+            tmp_filepath = os.path.join(self.tmp_dirpath, url_digest)
+            web.download_file(url, tmp_filepath, session)
+            try:
+                digest = get_file_digest(tmp_filepath)
+                size = os.path.getsize(tmp_filepath)
+                blob_filepath = self.get_blob_filepath(digest)
+                os.makedirs(os.path.dirname(blob_filepath), exist_ok=True)
+                # Такая же картинка могла прийти с другого адреса — тогда она уже лежит в хранилище
+                if not os.path.exists(blob_filepath):
+                    os.replace(tmp_filepath, blob_filepath)
+                protect_file(blob_filepath)
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_filepath)
+
+            with self._lock:
+                self._connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                                         (url, digest, size, time.time()))
+        return blob_filepath
+
+    def remove_stale_tmp_files(self, max_age=TMP_MAX_AGE) -> None:
+        """Удаляет из tmp брошенные загрузки, которых не касались дольше max_age секунд."""
+        stale_at = time.time() - max_age
+        with os.scandir(self.tmp_dirpath) as entries:
+            for entry in entries:
+                with suppress(OSError):
+                    if entry.is_file() and entry.stat().st_mtime < stale_at:
+                        os.remove(entry.path)
+
+
+def get_file_digest(filepath: str) -> str:
+    """SHA-256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def protect_file(filepath: str) -> None:
+    """Делает файл хранилища только для чтения (вместе со всеми его жёсткими ссылками)."""
+    if stat.S_IMODE(os.stat(filepath).st_mode) != READ_ONLY_MODE:
+        os.chmod(filepath, READ_ONLY_MODE)
+
+
+def link_cover(blob_filepath: str, filepath: str) -> None:
+    """
+    Помещает картинку из хранилища в каталог издательства жёсткой ссылкой,
+    а если файловая система их не поддерживает (или хранилище на другом диске) — копией.
+    Ссылка, как и картинка в хранилище, только для чтения: изменить её на месте нельзя.
+    """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    protect_file(blob_filepath)
+    tmp_filepath = f'{filepath}.{uuid.uuid4().hex}.tmp'
+    try:
+        try:
+            os.link(blob_filepath, tmp_filepath)
+        except OSError:
+            shutil.copyfile(blob_filepath, tmp_filepath)
+        try:
+            os.replace(tmp_filepath, filepath)
+        except PermissionError:
+            # Windows не заменяет файл только для чтения. Если это ссылка на другую картинку
+            # хранилища, та снова станет только для чтения при следующем link_cover
+            os.chmod(filepath, READ_ONLY_MODE | stat.S_IWUSR)
+            os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def get_cover_store() -> CoverStore:
+    """Общее для всех потоков хранилище обложек (создаётся при первом обращении)."""
+    global cover_store
+    with cover_store_lock:
+        if cover_store is None:
+            cover_store = CoverStore(files.get_covers_dirpath())
+    return cover_store
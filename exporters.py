@@ -0,0 +1,282 @@
+__doc__ = '''
+Выгрузка собранных книг в файлы разных форматов (xlsx, csv, jsonl, parquet).
+Все форматы используют столбцы files.BOOK_COLUMNS.
+'''
+
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import suppress
+
+import files
+from catalog import BooksCatalog
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet необязателен
+    pyarrow = None
+
+FORMAT_XLSX, FORMAT_CSV, FORMAT_JSONL, FORMAT_PARQUET = 'xlsx', 'csv', 'jsonl', 'parquet'
+DEFAULT_EXPORT_FORMATS = (FORMAT_XLSX,)
+BOOKS_FLUSH_BATCH_SIZE = 200
+EXCEL_CHECKPOINT_INTERVAL = 60
+EXCEL_CHECKPOINT_COST_FACTOR = 10
+# Ключи книг (files.BOOK_COLUMNS) — имена полей в jsonl и parquet
+COLUMN_KEYS = [column.key for column in files.BOOK_COLUMNS]
+
+books_catalog: BooksCatalog = None
+# Форматы выгрузки для приёмников книг, которым форматы не заданы явно (настройка export_formats)
+books_export_formats = DEFAULT_EXPORT_FORMATS
+
+
+def enable_catalog(db_filepath: str) -> None:
+    """Включает каталог книг: приёмники книг дописывают в него собранные книги."""
+    global books_catalog
+    books_catalog = BooksCatalog(db_filepath)
+
+
+def set_export_formats(export_formats) -> list:
+    """
+    Задаёт форматы выгрузки книг по умолчанию для приёмников книг.
+    Неизвестные форматы пропускаются и возвращаются списком; если известных
+    форматов не осталось, выгружается DEFAULT_EXPORT_FORMATS.
+    """
+    global books_export_formats
+    if isinstance(export_formats, str):
+        export_formats = [export_formats]
+    known_formats = [export_format for export_format in dict.fromkeys(export_formats) if export_format in EXPORTERS]
+    books_export_formats = tuple(known_formats) or DEFAULT_EXPORT_FORMATS
+    return [export_format for export_format in export_formats if export_format not in EXPORTERS]
+
+
+class CatalogExporter:
+    __doc__ = 'Запись книг издательства в каталог (upsert по магазину и ID товара или ISBN).'
+
+    def __init__(self, catalog: BooksCatalog, shop: str, publisher: str, seen_at: float):
+        self.catalog = catalog
+        self.shop = shop
+        self.publisher = publisher
+        self.seen_at = seen_at
+        self.count = 0
+
+    def write_rows(self, rows: list) -> None:
+        self.catalog.upsert_rows(self.shop, self.publisher, rows, self.seen_at, self.count)
+        self.count += len(rows)
+
+    def close(self) -> None:
+        pass
+
+
+class ExcelExporter:
+    __doc__ = '''
+    Выгрузка в xlsx. Ширину столбцов в режиме write-only нужно знать до первой строки,
+    поэтому строки сначала дописываются в журнал (JSON Lines), а книга Excel
+    собирается из журнала при закрытии и по ходу загрузки — раз в EXCEL_CHECKPOINT_INTERVAL
+    секунд, чтобы и после аварийного завершения в Excel файле были уже собранные книги.
+    Чтобы пересборка большой таблицы не замедляла загрузку, промежуток между
+    пересборками не меньше EXCEL_CHECKPOINT_COST_FACTOR длительностей прошлой.
+    '''
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.journal_filepath = files.get_books_journal_filepath(filepath)
+        self.width_tracker = files.ColumnWidthTracker()
+        self.count = 0
+        self._journal = open(self.journal_filepath, 'w', encoding='utf-8')
+        self._checkpoint_at = time.monotonic() + EXCEL_CHECKPOINT_INTERVAL
+
+    def write_rows(self, rows: list) -> None:
+        for row in rows:
+            self.width_tracker.update(row)
+            self._journal.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+        self._journal.flush()
+        self.count += len(rows)
+        if time.monotonic() >= self._checkpoint_at:
+            # Файл может быть открыт в Excel — тогда он запишется при следующей пересборке
+            with suppress(OSError):
+                self.write_workbook()
+
+    def iter_rows(self):
+        """Читает строки из журнала."""
+        with open(self.journal_filepath, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                yield json.loads(line)
+
+    def write_workbook(self) -> None:
+        """Собирает книгу Excel из строк, записанных в журнал к этому моменту."""
+        started_at = time.monotonic()
+        files.write_rows_to_excel_stream(self.filepath, self.iter_rows(), self.width_tracker.get_column_widths())
+        finished_at = time.monotonic()
+        self._checkpoint_at = finished_at + max(EXCEL_CHECKPOINT_INTERVAL,
+                                                (finished_at - started_at) * EXCEL_CHECKPOINT_COST_FACTOR)
+
+    def close(self) -> None:
+        self._journal.close()
+        if self.count:
+            self.write_workbook()
+        os.remove(self.journal_filepath)
+
+
+class CsvExporter:
+    __doc__ = 'Потоковая выгрузка в csv с заголовками столбцов Excel (UTF-8 с BOM, чтобы файл открывался в Excel).'
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._file = open(filepath, 'w', encoding='utf-8-sig', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(files.EXCEL_HEADERS)
+
+    def write_rows(self, rows: list) -> None:
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JsonlExporter:
+    __doc__ = 'Потоковая выгрузка в JSON Lines: по объекту с ключами COLUMN_KEYS на книгу.'
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._file = open(filepath, 'w', encoding='utf-8')
+
+    def write_rows(self, rows: list) -> None:
+        for row in rows:
+            self._file.write(json.dumps(dict(zip(COLUMN_KEYS, row)), ensure_ascii=False, default=str) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetExporter:
+    __doc__ = '''
+    Выгрузка в parquet (нужен пакет pyarrow), по группе строк на пачку.
+    Числовые столбцы получают числовой тип, а значения, которые не удалось
+    привести к числу, записываются как пустые.
+    '''
+
+    def __init__(self, filepath: str):
+        if pyarrow is None:
+            raise RuntimeError("Для выгрузки в parquet установите пакет pyarrow")
+        self.filepath = filepath
+        self.value_types = []
+        fields = []
+        for column in files.BOOK_COLUMNS:
+            if column.convert is files.to_int:
+                value_type, arrow_type = int, pyarrow.int64()
+            elif column.convert is files.to_float:
+                value_type, arrow_type = float, pyarrow.float64()
+            else:
+                value_type, arrow_type = str, pyarrow.string()
+            self.value_types.append(value_type)
+            fields.append(pyarrow.field(column.key, arrow_type))
+        self.schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(filepath, self.schema)
+
+    def write_rows(self, rows: list) -> None:
+        columns = []
+        for column_index, value_type in enumerate(self.value_types):
+            if value_type is str:
+                columns.append([str(row[column_index]) for row in rows])
+            else:
+                columns.append([row[column_index] if isinstance(row[column_index], (int, float)) else None
+                                for row in rows])
+        self._writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+EXPORTERS = {
+    FORMAT_XLSX: ExcelExporter,
+    FORMAT_CSV: CsvExporter,
+    FORMAT_JSONL: JsonlExporter,
+    FORMAT_PARQUET: ParquetExporter,
+}
+
+
+def get_export_filepath(excel_filepath: str, export_format: str) -> str:
+    """Путь к файлу выгрузки формата export_format рядом с Excel файлом издательства."""
+    return f'{os.path.splitext(excel_filepath)[0]}.{export_format}'
+
+
+class BooksSink:
+    __doc__ = '''
+    Приёмник книг, собираемых потоками загрузки.
+    Книги копятся пачками по batch_size, каждая пачка превращается в строки
+    таблицы и сразу передаётся всем выгрузкам из export_formats, поэтому в памяти
+    держится не больше одной пачки. Без export_formats берутся books_export_formats. Если задан каталог (catalog, shop, publisher),
+    пачки записываются и в него. Во все выгрузки, включая xlsx, попадают ровно
+    книги этого сбора, по строке на книгу.
+    close() дописывает остаток, закрывает все выгрузки (даже если какая-то из них
+    упала с ошибкой) и, если выгружался xlsx, сохраняет индекс ID и ISBN книг
+    (files.get_books_index).
+    '''
+
+    def __init__(self, excel_filepath: str, batch_size=BOOKS_FLUSH_BATCH_SIZE, export_formats=None,
+                 catalog: BooksCatalog = None, shop: str = None, publisher: str = None):
+        self.excel_filepath = excel_filepath
+        self.batch_size = batch_size
+        if not export_formats:
+            export_formats = books_export_formats
+        self.export_formats = export_formats
+        self.count = 0
+        self.ids = set()
+        self.isbn = set()
+        self._batch = []
+        self._lock = threading.Lock()
+        self.exporters = []
+        if catalog is not None:
+            self.exporters.append(CatalogExporter(catalog, shop, publisher, time.time()))
+        try:
+            for export_format in export_formats:
+                exporter_class = EXPORTERS[export_format]
+                self.exporters.append(exporter_class(get_export_filepath(excel_filepath, export_format)))
+        except Exception:
+            for exporter in self.exporters:
+                exporter.close()
+            raise
+
+    def add(self, book: dict) -> None:
+        """Принимает книгу; при наборе полной пачки сбрасывает её на диск."""
+        with self._lock:
+            self._batch.append(book)
+            self.count += 1
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        rows = [files.book_to_row(book) for book in self._batch]
+        for row in rows:
+            self.ids.add(str(row[files.ID_COLUMN - 1]))
+            self.isbn.add(str(row[files.ISBN_COLUMN - 1]))
+        for exporter in self.exporters:
+            exporter.write_rows(rows)
+        self._batch.clear()
+
+    def close(self) -> None:
+        """Дописывает остаток, закрывает выгрузки и сохраняет индекс книг."""
+        error = None
+        try:
+            with self._lock:
+                self._flush()
+        except Exception as exception:
+            error = exception
+        # Каждая выгрузка закрывается отдельно: занятый xlsx не должен оставить открытым csv
+        # или parquet без завершающего блока; первая ошибка пробрасывается после закрытия всех
+        for exporter in self.exporters:
+            try:
+                exporter.close()
+            except Exception as exception:
+                error = error or exception
+        if error is not None:
+            raise error
+        if FORMAT_XLSX in self.export_formats and os.path.exists(self.excel_filepath):
+            files.write_books_index(self.excel_filepath, self.ids, self.isbn)
@@ -1,74 +1,177 @@
 __doc__ = '\nФункции работы с файлами и папками.\n'
 
 import inspect
+import itertools
+import json
+import math
 import os
 import re
 import sys
+import zipfile
 from contextlib import suppress
 
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import InvalidFileException
 
 MAX_DIR_NAME_LENGTH = 255
+SETTINGS_FILENAME = 'settings.json'
+DEFAULT_SETTINGS = {
+    # Дисковый кэш страниц: повторный сбор в пределах http_cache_ttl секунд берёт страницы
+    # из кэша, поэтому цены и наличие в нём могут быть не самыми свежими
+    'http_cache': False,
+    'http_cache_ttl': 60 * 60,
+    # Форматы выгрузки книг: xlsx, csv, jsonl, parquet (для parquet нужен пакет pyarrow)
+    'export_formats': ['xlsx'],
+}
+ISBN_COLUMN, NAME_COLUMN, YEAR_COLUMN, DESCRIPTION_COLUMN, PRICE_COLUMN, ID_COLUMN = 1, 2, 11, 22, 23, 24
+DESCRIPTION_MAX_WIDTH = 20
+# Больше строк в одном Excel файле не пишется, остальные уходят в следующие файлы (None — без деления)
+EXCEL_SHARD_ROWS = 50000
+# Начало имён стилей таблицы книг, чтобы они не совпали со встроенными стилями Excel
+EXCEL_STYLE_PREFIX = 'Books'
+INTEGER_FORMAT = '0'
+PRICE_FORMAT = '#,##0.00 _?'
+INTEGER_PATTERN = re.compile(r'\s*[+-]?\d+\s*')
+FLOAT_PATTERN = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*')
+
+
+def to_int(value):
+    """Приводит значение к int, если оно похоже на целое число, иначе возвращает его как есть."""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        return int(value) if INTEGER_PATTERN.fullmatch(value) else value
+    if isinstance(value, float) and math.isfinite(value):
+        return int(value)
+    return value
+
+
+def to_float(value):
+    """Приводит значение к float, если оно похоже на число, иначе возвращает его как есть."""
+    if isinstance(value, float):
+        return value
+    if isinstance(value, int):
+        return float(value)
+    if isinstance(value, str):
+        return float(value) if FLOAT_PATTERN.fullmatch(value) else value
+    return value
+
+
+class ExcelColumn:
+    __doc__ = '''
+    Описание столбца таблицы книг: заголовок, ключ в словаре книги,
+    приведение типа, формат чисел, выравнивание и правило ширины
+    (добавка к ширине по содержимому и предельная ширина).
+    '''
+
+    def __init__(self, header: str, key: str, convert=None, number_format=None,
+                 horizontal='left', extra_width=0, max_width=None):
+        self.header = header
+        self.key = key
+        self.convert = convert
+        self.number_format = number_format
+        self.horizontal = horizontal
+        self.extra_width = extra_width
+        self.max_width = max_width
+
+    def get_width(self, max_length: int) -> int:
+        """Ширина столбца по длине самого длинного значения."""
+        # Добавляем немного ширины столбцу (для отступов)
+        width = max_length + 2 + self.extra_width
+        if self.max_width is not None:
+            width = min(width, self.max_width)
+        return width
+
+
+BOOK_COLUMNS = [
+    ExcelColumn('ISBN', 'isbn', to_int, INTEGER_FORMAT),
+    ExcelColumn('Название', 'name'),
+    ExcelColumn('Название языка', 'language'),
+    ExcelColumn('Серия', 'series'),
+    ExcelColumn('Название издательства или производителя', 'publisher'),
+    ExcelColumn('Авторы', 'authors'),
+    ExcelColumn('Категория товара', 'category'),
+    ExcelColumn('Возрастная категория', 'age_category', to_int),
+    ExcelColumn('Переплёт', 'cover'),
+    ExcelColumn('Страна производитель', 'country'),
+    ExcelColumn('Год издания', 'year', to_int, INTEGER_FORMAT),
+    ExcelColumn('Вид товара', 'type'),
+    ExcelColumn('Количество страниц', 'pages', to_int),
+    ExcelColumn('Размеры', 'dimensions'),
+    ExcelColumn('Длина', 'length'),
+    ExcelColumn('Ширина', 'width'),
+    ExcelColumn('Высота', 'height'),
+    ExcelColumn('Класс', 'grade', to_int),
+    ExcelColumn('Вес', 'weight', to_int),
+    ExcelColumn('Цвет', 'color'),
+    ExcelColumn('Тип бумаги', 'paper'),
+    ExcelColumn('Описание', 'description', max_width=DESCRIPTION_MAX_WIDTH),
+    ExcelColumn('Цена', 'price', to_float, PRICE_FORMAT, extra_width=6),
+    ExcelColumn('ID', 'ID', to_int),
+]
+EXCEL_HEADERS = [column.header for column in BOOK_COLUMNS]
+
+# Общие объекты стилей таблицы книг
+THIN_SIDE = openpyxl.styles.Side(style='thin')
+THIN_BORDER = openpyxl.styles.Border(left=THIN_SIDE, right=THIN_SIDE, top=THIN_SIDE, bottom=THIN_SIDE)
+BOLD_FONT = openpyxl.styles.Font(bold=True)
+HEADER_ALIGNMENT = openpyxl.styles.Alignment(horizontal='center', vertical='center')
+DATA_ALIGNMENTS = {
+    'left': openpyxl.styles.Alignment(horizontal='left', vertical='center'),
+    'center': openpyxl.styles.Alignment(horizontal='center', vertical='center'),
+}
+
+
+def get_settings_filepath() -> str:
+    """Формирует путь к файлу настроек программы (рядом с программой)."""
+    return os.path.join(get_script_dirpath(), SETTINGS_FILENAME)
+
+
+def read_settings() -> dict:
+    """
+    Читает настройки программы из файла настроек (JSON-объект).
+    Отсутствующие в файле настройки, как и сам отсутствующий или испорченный файл,
+    заменяются значениями из DEFAULT_SETTINGS.
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    with suppress(OSError, ValueError):
+        with open(get_settings_filepath(), 'r', encoding='utf-8') as settings_file:
+            user_settings = json.load(settings_file)
+        if isinstance(user_settings, dict):
+            settings.update((name, user_settings[name]) for name in DEFAULT_SETTINGS if name in user_settings)
+    return settings
 
 
-def adjust_column_widths(excel_filepath: str):
-    """Автоматически подгоняет ширину столбцов в файле Excel."""
-    workbook = openpyxl.load_workbook(excel_filepath)
-    worksheet = workbook.active
-
-    # Создаем стиль для границ
-    border_style = openpyxl.styles.Border(
-        left=openpyxl.styles.Side(style='thin'),
-        right=openpyxl.styles.Side(style='thin'),
-        top=openpyxl.styles.Side(style='thin'),
-        bottom=openpyxl.styles.Side(style='thin')
-    )
-
-    # Создаем стиль выравнивания (по левому краю для ячеек, кроме заголовков)
-    left_alignment = openpyxl.styles.Alignment(horizontal='left', vertical='center')
-
-    # Создаем стиль для выравнивания заголовков по центру
-    center_alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-    for column_number, column_cells in enumerate(worksheet.columns, 1):
-        max_column_width = 0
+def get_data_dirpath() -> str:
+    """Формирует путь к каталогу данных для работы программы."""
+    return os.path.join(get_script_dirpath(), '.data')
 
-        # Пробегаем по всем ячейкам в столбце и ищем максимальную длину строки
-        for cell in column_cells:
-            column_width = len(str(cell.value))
-            if column_width > max_column_width:
-                max_column_width = column_width
 
-        # Добавляем немного ширины столбцу (для отступов)
-        max_column_width += 2
+def get_http_cache_filepath() -> str:
+    """Формирует путь к базе кэша HTTP-ответов."""
+    return os.path.join(get_data_dirpath(), 'http_cache.sqlite3')
 
-        # Для столбца "Цена" добавляем немного ширины
-        if column_number == 23:
-            max_column_width += 6
 
-        # Для столбца "Описание" ограничиваем ширину
-        if column_number == 22:
-            max_column_width = min(max_column_width, 20)  # Ограничиваем ширину 20 символами
+def get_catalog_filepath() -> str:
+    """Формирует путь к базе каталога собранных книг."""
+    return os.path.join(get_data_dirpath(), 'catalog.sqlite3')
 
-        # Устанавливаем ширину столбца
-        worksheet.column_dimensions[column_cells[0].column_letter].width = max_column_width
 
-        # Применяем выравнивание и границы для всех ячеек в столбце
-        for row_number, cell in enumerate(column_cells):
-            cell.border = border_style
+def get_covers_dirpath() -> str:
+    """Формирует путь к общему хранилищу картинок обложек."""
+    return os.path.join(get_data_dirpath(), 'covers')
 
-            # Если это первая строка (заголовки), выравниваем по центру
-            if row_number == 0:
-                cell.alignment = center_alignment
-            else:
-                cell.alignment = left_alignment
 
-    workbook.save(excel_filepath)
+def get_cookies_filepath(shop: str) -> str:
+    """Формирует путь к файлу cookies магазина."""
+    return os.path.join(get_data_dirpath(), f"{cut_shop_to_site(shop)}_cookies.txt")
 
 
-def get_data_dirpath() -> str:
-    """Формирует путь к каталогу данных для работы программы."""
-    return os.path.join(get_script_dirpath(), '.data')
+def get_fixtures_dirpath(shop: str) -> str:
+    """Формирует путь к каталогу записанных ответов сайта магазина."""
+    return os.path.join(get_data_dirpath(), 'fixtures', shop)
 
 
 def get_excel_filepath(shop: str, publisher: str) -> str:
@@ -121,9 +224,9 @@ def get_shop_dirpath(shop: str) -> str:
     return os.path.join(get_shops_dirpath(), shop)
 
 
-def get_xml_dirpath(shop: str) -> str:
-    """Формирует путь к .xml файлу конкретного магазина."""
-    return os.path.join(get_shop_dirpath(shop), f'{cut_shop_to_site(shop)}.xml')
+def get_feed_filepath(shop: str) -> str:
+    """Формирует путь к YML-выгрузке магазина, сохранённой в исходной кодировке."""
+    return os.path.join(get_shop_dirpath(shop), f'{cut_shop_to_site(shop)}.yml')
 
 
 def get_shop_publisher_dirpath(shop: str, publisher: str) -> str:
@@ -158,6 +261,17 @@ def normalize_dir_name(dir_name: str) -> str:
     return dir_name
 
 
+def scan_filenames(dirpath: str) -> set:
+    """
+    Имена файлов каталога, прочитанные одним проходом os.scandir
+    (без отдельного запроса к файловой системе на каждый файл).
+    """
+    with suppress(FileNotFoundError):
+        with os.scandir(dirpath) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    return set()
+
+
 def is_file_exists(filepath):
     return os.path.exists(filepath)
 
@@ -169,6 +283,13 @@ def prepare_excel_file(excel_filepath: str) -> None:
     полужирным шрифтом и обводит ячейки с ними рамками.
     """
 
+    # Удаляем и части таблицы, записанные прошлым сбором
+    for shard_filepath in get_excel_shard_filepaths(excel_filepath)[1:]:
+        with suppress(FileNotFoundError):
+            os.remove(shard_filepath)
+    with suppress(FileNotFoundError):
+        os.remove(get_excel_manifest_filepath(excel_filepath))
+
     if os.path.exists(excel_filepath):
         # Delete file
         os.remove(excel_filepath)
@@ -182,24 +303,12 @@ def prepare_excel_file(excel_filepath: str) -> None:
     # else:
     workbook = openpyxl.Workbook()
     worksheet = workbook.worksheets[0]
-    worksheet.append([
-        'ISBN', 'Название', 'Название языка', 'Серия',
-        'Название издательства или производителя', 'Авторы',
-        'Категория товара', 'Возрастная категория', 'Переплёт',
-        'Страна производитель', 'Год издания', 'Вид товара',
-        'Количество страниц', 'Размеры', 'Длина', 'Ширина',
-        'Высота', 'Класс', 'Вес', 'Цвет', 'Тип бумаги', 'Описание', 'Цена', 'ID'
-    ])
+    worksheet.append(EXCEL_HEADERS)
     first_row = worksheet[1]
-    alignment = openpyxl.styles.Alignment(horizontal='center',
-                                          vertical='center')
     for cell in first_row:
-        cell.font = openpyxl.styles.Font(bold=True)
-        cell.border = openpyxl.styles.Border(left=openpyxl.styles.Side(style='thin'),
-                                             right=openpyxl.styles.Side(style='thin'),
-                                             top=openpyxl.styles.Side(style='thin'),
-                                             bottom=openpyxl.styles.Side(style='thin'))
-        cell.alignment = alignment
+        cell.font = BOLD_FONT
+        cell.border = THIN_BORDER
+        cell.alignment = HEADER_ALIGNMENT
 
     workbook.save(excel_filepath)
 
@@ -241,107 +350,248 @@ def read_publishers(shop: str):
     return publishers
 
 
-def get_books_rows_from_excel(excel_filepath, row_id):
-    """Получает информацию об ISBN книг в файле Excel."""
-    workbook = openpyxl.load_workbook(excel_filepath)
-    worksheet = workbook.active
+def get_books_index_filepath(excel_filepath: str) -> str:
+    """Формирует путь к индексу ID и ISBN книг, записанных в Excel файл."""
+    return os.path.splitext(excel_filepath)[0] + ' index.json'
 
-    isbn = []
-    for row in worksheet.iter_rows(2, worksheet.max_row):
-        isbn.append(str(row[row_id].value))
-    return isbn
 
+def get_file_signature(filepath: str) -> list:
+    """Время изменения и размер файла, по которым проверяется актуальность индекса."""
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
 
-def try_to_change_type(obj, new_type):
+
+def write_books_index(excel_filepath: str, ids, isbn) -> None:
+    """Сохраняет рядом с Excel файлом индекс ID и ISBN записанных в него книг."""
+    index = {'excel': get_file_signature(excel_filepath), 'ids': sorted(ids), 'isbn': sorted(isbn)}
+    index_filepath = get_books_index_filepath(excel_filepath)
+    with open(index_filepath + '.tmp', 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file, ensure_ascii=False)
+    os.replace(index_filepath + '.tmp', index_filepath)
+
+
+def get_books_index(excel_filepath: str) -> dict:
+    """
+    Возвращает ID и ISBN книг, уже записанных в Excel файл: {'ids': set, 'isbn': set}.
+    Берёт их из индекса рядом с файлом, а если индекса нет или файл с тех пор
+    изменился, один раз читает оба столбца из файла (и остальных его частей,
+    см. write_rows_to_excel_stream) и сохраняет индекс заново.
+    Если файл не читается (испорчен, обрезан, недоступен), возвращает пустые множества.
+    """
+    if not os.path.exists(excel_filepath):
+        return {'ids': set(), 'isbn': set()}
+
+    with suppress(FileNotFoundError, ValueError, KeyError):
+        with open(get_books_index_filepath(excel_filepath), 'r', encoding='utf-8') as index_file:
+            index = json.load(index_file)
+        if index['excel'] == get_file_signature(excel_filepath):
+            return {'ids': set(index['ids']), 'isbn': set(index['isbn'])}
+
+    ids, isbn = set(), set()
     try:
-        new_obj = new_type(obj)
-    except (ValueError, TypeError):
-        new_obj = obj
-    return new_obj
-
-
-def write_books_to_excel(excel_filepath: str, books: list):
-    """Сохраняет информацию о книгах в файле Excel."""
-    workbook = openpyxl.load_workbook(excel_filepath)
-    worksheet = workbook.active
-    start_row = worksheet.max_row + 1
-    for book in books:
-        # print("description " + book.get("description", " "))
-        isbn = try_to_change_type(book.get('isbn', ' '), int)
-        year = try_to_change_type(book.get('year', ' '), int)
-        price = try_to_change_type(book.get('price', ' '), float)
-        age_category = try_to_change_type(book.get('age_category', ' '), int)
-        pages = try_to_change_type(book.get('pages', ' '), int)
-        weight = try_to_change_type(book.get('weight', ' '), int)
-        b_id = try_to_change_type(book.get('ID', ' '), int)
-        grade = try_to_change_type(book.get('grade', ' '), int)
-
-        worksheet.append([
-            isbn, book.get('name', ' '), book.get('language', ' '),
-            book.get('series', ' '), book.get('publisher', ' '),
-            book.get('authors', ' '), book.get('category', ' '),
-            age_category, book.get('cover', ' '),
-            book.get('country', ' '), year, book.get('type', ' '),
-            pages, book.get('dimensions', ' '),
-            book.get('length', ' '), book.get('width', ' '),
-            book.get('height', ' '), grade,
-            weight, book.get('color', ' '),
-            book.get('paper', ' '),
-            book.get('description', ' '),
-            price, b_id
-        ])
-
-    left_alignment = openpyxl.styles.Alignment(horizontal='left', vertical='bottom')
-    center_alignment = openpyxl.styles.Alignment(horizontal='center', vertical='bottom')
-    for row in worksheet.iter_rows(min_row=start_row, max_row=(worksheet.max_row), min_col=1, max_col=24):
-        for cell_number, cell in enumerate(row, 1):
-            cell.border = openpyxl.styles.Border(left=openpyxl.styles.Side(style='thin'),
-                                                 right=openpyxl.styles.Side(style='thin'),
-                                                 top=openpyxl.styles.Side(style='thin'),
-                                                 bottom=openpyxl.styles.Side(style='thin'))
-            if cell_number in (1, 11):
-                with suppress(ValueError, TypeError):
-                    if str(cell.value):
-                        if int(cell.value):
-                            cell.number_format = '0'
-                cell.alignment = left_alignment
+        for shard_filepath in get_excel_shard_filepaths(excel_filepath):
+            workbook = openpyxl.load_workbook(shard_filepath, read_only=True)
+            try:
+                for row in workbook.active.iter_rows(min_row=2, values_only=True):
+                    if len(row) >= ID_COLUMN:
+                        ids.add(str(row[ID_COLUMN - 1]))
+                        isbn.add(str(row[ISBN_COLUMN - 1]))
+            finally:
+                workbook.close()
+    except (zipfile.BadZipFile, InvalidFileException, OSError):
+        # Испорченный или недописанный файл не должен мешать новому сбору: книги собираются заново
+        return {'ids': set(), 'isbn': set()}
+    write_books_index(excel_filepath, ids, isbn)
+    return {'ids': ids, 'isbn': isbn}
+
+
+# Пары (ключ книги, приведение типа) в порядке столбцов, чтобы не разбирать схему на каждой строке
+BOOK_ROW_PLAN = [(column.key, column.convert) for column in BOOK_COLUMNS]
+
+
+def book_to_row(book: dict) -> list:
+    """Превращает информацию о книге в строку таблицы в порядке столбцов BOOK_COLUMNS."""
+    get = book.get
+    return [convert(get(key, ' ')) if convert else get(key, ' ') for key, convert in BOOK_ROW_PLAN]
+
+
+class ColumnWidthTracker:
+    __doc__ = 'Считает ширину столбцов Excel по мере прохождения строк.'
+
+    def __init__(self, headers=EXCEL_HEADERS):
+        self.max_lengths = [len(str(header)) for header in headers]
+
+    def update(self, row) -> None:
+        """Учитывает длину значений очередной строки."""
+        max_lengths = self.max_lengths
+        for column_index, value in enumerate(row):
+            length = len(value) if isinstance(value, str) else len(str(value))
+            if length > max_lengths[column_index]:
+                max_lengths[column_index] = length
+
+    def get_column_widths(self) -> list:
+        """Возвращает ширины столбцов по правилам из BOOK_COLUMNS."""
+        return [column.get_width(max_length) for column, max_length in zip(BOOK_COLUMNS, self.max_lengths)]
+
+
+def write_rows_to_excel_stream(excel_filepath: str, rows, column_widths=None, max_rows=EXCEL_SHARD_ROWS) -> list:
+    """
+    Записывает Excel файл со строками книг (см. book_to_row) за один проход в режиме write-only:
+    заголовок, строки с типами и форматами чисел, рамки и итоговую ширину столбцов.
+    column_widths — готовые ширины столбцов; если они не заданы, считаются по строкам перед записью.
+    Если строк больше max_rows, они делятся на несколько файлов: первый — excel_filepath,
+    следующие — get_excel_shard_filepath, и рядом сохраняется манифест частей
+    (get_excel_manifest_filepath). Возвращает пути записанных файлов.
+    """
+    if column_widths is None:
+        rows = list(rows)
+        width_tracker = ColumnWidthTracker()
+        for row in rows:
+            width_tracker.update(row)
+        column_widths = width_tracker.get_column_widths()
+
+    old_shard_filepaths = get_excel_shard_filepaths(excel_filepath)
+    shards = []
+    rows = iter(rows)
+    while True:
+        shard_filepath = get_excel_shard_filepath(excel_filepath, len(shards) + 1)
+        shard_rows = itertools.islice(rows, max_rows) if max_rows else rows
+        # Первую часть пишем всегда (хотя бы с одними заголовками), пустые последующие — нет
+        rows_count = write_excel_shard(shard_filepath, shard_rows, column_widths, skip_empty=bool(shards))
+        if rows_count is None:
+            break
+        shards.append({'file': os.path.basename(shard_filepath), 'rows': rows_count})
+        if not max_rows or rows_count < max_rows:
+            break
+
+    excel_dirpath = os.path.dirname(excel_filepath)
+    shard_filepaths = [os.path.join(excel_dirpath, shard['file']) for shard in shards]
+    for old_shard_filepath in set(old_shard_filepaths) - set(shard_filepaths):
+        with suppress(FileNotFoundError):
+            os.remove(old_shard_filepath)
+
+    manifest_filepath = get_excel_manifest_filepath(excel_filepath)
+    if len(shards) > 1:
+        manifest = {'headers': EXCEL_HEADERS, 'max_rows': max_rows,
+                    'total_rows': sum(shard['rows'] for shard in shards), 'shards': shards}
+        with open(manifest_filepath + '.tmp', 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file, ensure_ascii=False, indent=1)
+        os.replace(manifest_filepath + '.tmp', manifest_filepath)
+    else:
+        with suppress(FileNotFoundError):
+            os.remove(manifest_filepath)
+    return shard_filepaths
+
+
+def write_excel_shard(excel_filepath: str, rows, column_widths: list, skip_empty=False):
+    """
+    Записывает одну часть таблицы книг в режиме write-only.
+    Возвращает число записанных строк или None, если строк нет и skip_empty (файл тогда не создаётся).
+    """
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None and skip_empty:
+        return None
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    # В режиме write-only ширина столбцов задаётся до первой строки
+    for column_number, width in enumerate(column_widths, 1):
+        worksheet.column_dimensions[get_column_letter(column_number)].width = width
+
+    # Стили заголовка и ячеек столбцов регистрируются в книге один раз, а ячейкам раздаются по имени
+    header_style, text_styles, number_styles = add_column_styles(workbook)
+    header_cells = []
+    for header in EXCEL_HEADERS:
+        cell = WriteOnlyCell(worksheet, value=header)
+        cell.style = header_style
+        header_cells.append(cell)
+    worksheet.append(header_cells)
+
+    rows_count = 0
+    for row in itertools.chain([first_row] if first_row is not None else [], rows):
+        cells = []
+        for value, text_style, number_style in zip(row, text_styles, number_styles):
+            cell = WriteOnlyCell(worksheet, value=value)
+            if number_style is not None and value and isinstance(value, (int, float)):
+                cell.style = number_style
             else:
-                if cell_number == 23:
-                    with suppress(ValueError):
-                        if str(cell.value):
-                            if float(cell.value):
-                                cell.number_format = '#,##0.00 _?'
-                    cell.alignment = center_alignment
-                else:
-                    cell.alignment = left_alignment
+                cell.style = text_style
+            cells.append(cell)
+        worksheet.append(cells)
+        rows_count += 1
 
-    workbook.save(excel_filepath)
+    # Файл заменяется целиком, поэтому прерванная запись не портит прежнюю таблицу
+    tmp_filepath = excel_filepath + '.tmp'
+    try:
+        workbook.save(tmp_filepath)
+        os.replace(tmp_filepath, excel_filepath)
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_filepath)
+    return rows_count
 
 
-def write_publishers(shop: str, publishers: list) -> None:
-    """Записывает список издательств в файл издательств магазина."""
-    make_invisible_dir(get_data_dirpath())
-    publishers_filepath = get_publishers_filepath(shop)
-    with open(publishers_filepath, 'w', encoding='utf-8') as publishers_file:
-        publishers_file.write('\n'.join(publishers))
+def get_excel_shard_filepath(excel_filepath: str, shard_number: int) -> str:
+    """Путь к части shard_number (с 1) таблицы книг; первая часть — сам excel_filepath."""
+    if shard_number == 1:
+        return excel_filepath
+    base, extension = os.path.splitext(excel_filepath)
+    return f'{base} ({shard_number}){extension}'
+
 
+def get_excel_manifest_filepath(excel_filepath: str) -> str:
+    """Формирует путь к манифесту частей таблицы книг."""
+    return os.path.splitext(excel_filepath)[0] + ' manifest.json'
 
-def save_xml_to_file(shop: str, request):
-    """Сохраняет xml-файл со всей БД в файл."""
-    xml_filename = get_xml_dirpath(shop)
 
-    # Save orig temp file
-    with open(xml_filename, "w", encoding="utf-8") as file:
-        file.write(request.text)
+def get_excel_shard_filepaths(excel_filepath: str) -> list:
+    """Пути всех частей таблицы книг по манифесту (без манифеста — только excel_filepath)."""
+    with suppress(FileNotFoundError, ValueError, KeyError):
+        with open(get_excel_manifest_filepath(excel_filepath), 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        excel_dirpath = os.path.dirname(excel_filepath)
+        return [os.path.join(excel_dirpath, shard['file']) for shard in manifest['shards']]
+    return [excel_filepath]
+
+
+def add_column_styles(workbook) -> tuple:
+    """
+    Регистрирует в книге именованные стили таблицы книг: стиль заголовков и по BOOK_COLUMNS
+    стили ячеек данных каждого столбца — для текста и, если у столбца есть формат чисел,
+    для ненулевых чисел. Столбцы с одинаковым оформлением получают один стиль: openpyxl
+    ищет стиль по имени перебором, и чем стилей меньше, тем быстрее запись.
+    Возвращает имена стилей: (заголовок, [текст по столбцам], [число или None по столбцам]).
+    """
+    def add_style(name, **style_settings):
+        if name not in workbook.named_styles:
+            workbook.add_named_style(openpyxl.styles.NamedStyle(name=name, border=THIN_BORDER, **style_settings))
+        return name
 
+    header_style = add_style(f'{EXCEL_STYLE_PREFIX} header', font=BOLD_FONT, alignment=HEADER_ALIGNMENT)
+    text_styles, number_styles = [], []
+    for column in BOOK_COLUMNS:
+        alignment = DATA_ALIGNMENTS[column.horizontal]
+        text_styles.append(add_style(f'{EXCEL_STYLE_PREFIX} {column.horizontal}', alignment=alignment))
+        if column.number_format:
+            number_styles.append(add_style(f'{EXCEL_STYLE_PREFIX} {column.horizontal} {column.number_format}',
+                                           alignment=alignment, number_format=column.number_format))
+        else:
+            number_styles.append(None)
+    return header_style, text_styles, number_styles
 
-def get_correct_xml_content(shop: str) -> str:
-    """Возвращает содержимое xml-файла, исправляя кодировку."""
-    with open(get_xml_dirpath(shop), "r", encoding="utf-8") as f:
-        orig_content = f.read()
 
-    content = orig_content.replace('encoding="windows-1251"', 'encoding="utf-8"')
-    return content
+def get_books_journal_filepath(excel_filepath: str) -> str:
+    """Формирует путь к журналу книг, собранных во время загрузки в Excel файл."""
+    return excel_filepath + '.journal'
+
+
+def write_publishers(shop: str, publishers: list) -> None:
+    """Записывает список издательств в файл издательств магазина."""
+    make_invisible_dir(get_data_dirpath())
+    publishers_filepath = get_publishers_filepath(shop)
+    with open(publishers_filepath, 'w', encoding='utf-8') as publishers_file:
+        publishers_file.write('\n'.join(publishers))
 
 
 def sanitize_filename(name: str) -> str:
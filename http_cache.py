@@ -0,0 +1,133 @@
+__doc__ = '\nДисковый кэш HTTP-ответов с условной перепроверкой (ETag/Last-Modified).\n'
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CACHE_TTL = 60 * 60
+CACHE_MAX_SIZE = 1024 ** 3
+EVICTION_RATIO = 0.9
+# Заголовки, которые описывают передачу, а не само содержимое (в кэше тело уже распаковано)
+SKIPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie')
+
+
+class HttpCache:
+    __doc__ = '''
+    Кэш ответов на GET-запросы в базе SQLite.
+    Свежий (моложе ttl секунд) ответ отдаётся без запроса к сайту, устаревший
+    перепроверяется заголовками If-None-Match/If-Modified-Since. Общий объём
+    ограничен max_size байт: при переполнении удаляются давно не читанные ответы.
+    '''
+
+    def __init__(self, db_filepath: str, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_filepath), exist_ok=True)
+        self._connection = sqlite3.connect(db_filepath, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(url: str, params=None) -> str:
+        """Формирует ключ кэша по адресу и параметрам запроса."""
+        query = urlencode(sorted(dict(params).items()), doseq=True) if params else ''
+        return hashlib.sha1(f'{url}?{query}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """Возвращает запись кэша или None."""
+        with self._lock:
+            entry = self._connection.execute('SELECT * FROM responses WHERE key = ?', (key,)).fetchone()
+            if entry:
+                self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return entry
+
+    def is_fresh(self, entry) -> bool:
+        """Проверяет, можно ли отдать запись без обращения к сайту."""
+        return time.time() - entry['stored_at'] < self.ttl
+
+    @staticmethod
+    def get_conditional_headers(entry) -> dict:
+        """Заголовки условного запроса для перепроверки записи."""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key: str, response) -> None:
+        """Сохраняет успешный ответ, если его можно кэшировать."""
+        if response.status_code != 200 or 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        body = response.content
+        if len(body) > self.max_size * (1 - EVICTION_RATIO):
+            return
+
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_HEADERS}
+        now = time.time()
+        with self._lock:
+            old_entry = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, response.status_code, json.dumps(headers), body,
+                 response.headers.get('ETag'), response.headers.get('Last-Modified'), len(body), now, now))
+            self._size += len(body) - (old_entry['size'] if old_entry else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def revalidate(self, key: str, response) -> None:
+        """Продлевает жизнь записи после ответа 304 Not Modified."""
+        with self._lock:
+            self._connection.execute(
+                'UPDATE responses SET stored_at = ?, etag = COALESCE(?, etag), '
+                'last_modified = COALESCE(?, last_modified) WHERE key = ?',
+                (time.time(), response.headers.get('ETag'), response.headers.get('Last-Modified'), key))
+
+    @staticmethod
+    def to_response(entry):
+        """Собирает объект requests.Response из записи кэша."""
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = 'OK'
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(json.loads(entry['headers']))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = entry['body']
+        return response
+
+    def _evict(self) -> None:
+        """Удаляет давно не читанные записи, пока кэш не станет меньше лимита."""
+        target_size = self.max_size * EVICTION_RATIO
+        cursor = self._connection.execute('SELECT key, size FROM responses ORDER BY accessed_at')
+        evicted_keys = []
+        for row in cursor:
+            if self._size <= target_size:
+                break
+            evicted_keys.append((row['key'],))
+            self._size -= row['size']
+        cursor.close()
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
@@ -0,0 +1,89 @@
+__doc__ = '\nЗапись HTTP-ответов в локальное хранилище и их воспроизведение без сети.\n'
+
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+MODE_OFF, MODE_RECORD, MODE_REPLAY = 'off', 'record', 'replay'
+# Заголовки запроса, от которых зависит ответ и которые входят в ключ записи
+KEY_HEADERS = ('Range',)
+# В записи тело уже распаковано, поэтому заголовки передачи не сохраняются
+SKIPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection')
+
+
+class FixtureStore:
+    __doc__ = '''
+    Хранилище записанных ответов: для каждого запроса файл <ключ>.json
+    со статусом, заголовками и временем ответа и файл <ключ>.body с телом.
+    При воспроизведении ответ задерживается на latency секунд, а если latency
+    не задана — на время, за которое сайт ответил при записи.
+    '''
+
+    def __init__(self, dirpath: str, latency=None):
+        self.dirpath = dirpath
+        self.latency = latency
+        os.makedirs(dirpath, exist_ok=True)
+
+    @staticmethod
+    def make_key(url: str, params=None, headers=None) -> str:
+        """Формирует ключ записи по адресу, параметрам и значимым заголовкам запроса."""
+        query = urlencode(sorted(dict(params).items()), doseq=True) if params else ''
+        key_headers = [f'{name}={headers[name]}' for name in KEY_HEADERS if headers and name in headers]
+        return hashlib.sha1('|'.join([url, query, *key_headers]).encode('utf-8')).hexdigest()
+
+    def record(self, url: str, params, headers, response) -> None:
+        """Сохраняет ответ сайта (тело при этом читается целиком)."""
+        key = self.make_key(url, params, headers)
+        body = response.content
+        meta = {
+            'url': response.url,
+            'request_url': url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {name: value for name, value in response.headers.items()
+                        if name.lower() not in SKIPPED_HEADERS},
+            'elapsed': response.elapsed.total_seconds(),
+        }
+        body_filepath = os.path.join(self.dirpath, f'{key}.body')
+        with open(body_filepath + '.tmp', 'wb') as body_file:
+            body_file.write(body)
+        os.replace(body_filepath + '.tmp', body_filepath)
+        meta_filepath = os.path.join(self.dirpath, f'{key}.json')
+        with open(meta_filepath + '.tmp', 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False)
+        os.replace(meta_filepath + '.tmp', meta_filepath)
+
+    def replay(self, url: str, params=None, headers=None):
+        """
+        Возвращает записанный ответ как requests.Response.
+        Если запрос не записывался, возвращает ответ 404, чтобы парсер сразу перешёл дальше.
+        """
+        key = self.make_key(url, params, headers)
+        response = requests.Response()
+        try:
+            with open(os.path.join(self.dirpath, f'{key}.json'), encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            with open(os.path.join(self.dirpath, f'{key}.body'), 'rb') as body_file:
+                body = body_file.read()
+        except FileNotFoundError:
+            response.status_code = 404
+            response.reason = 'Not Recorded'
+            response.url = url
+            response._content = b''
+            return response
+
+        time.sleep(self.latency if self.latency is not None else meta['elapsed'])
+
+        response.status_code = meta['status']
+        response.reason = meta['reason']
+        response.url = meta['url']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = body
+        response._content_consumed = True
+        return response
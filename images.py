@@ -0,0 +1,174 @@
+__doc__ = '\nПроверка, перевод в JPEG и уменьшение картинок обложек в отдельных процессах.\n'
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:  # Обработка картинок необязательна
+    Image = None
+
+JPEG_QUALITY = 90
+THUMBNAIL_SIZE = (200, 200)
+BACKGROUND_COLOR = (255, 255, 255)
+
+image_processor = None
+image_processor_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    """Установлен ли Pillow, без которого картинки не обрабатываются."""
+    return Image is not None
+
+
+def open_image(filepath: str):
+    """Открывает картинку, проверив, что файл действительно картинка; иначе возвращает None."""
+    try:
+        with Image.open(filepath) as image:
+            image.verify()
+        # После verify картинку нужно открыть заново
+        return Image.open(filepath)
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return None
+
+
+def to_rgb(image):
+    """Переводит картинку в RGB, подкладывая под прозрачные участки белый фон."""
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, BACKGROUND_COLOR)
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def save_jpeg(image, filepath: str, quality: int) -> None:
+    """Сохраняет картинку в JPEG атомарно (через временный файл)."""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = f'{filepath}.{uuid.uuid4().hex}.tmp'
+    try:
+        to_rgb(image).save(tmp_filepath, 'JPEG', quality=quality, optimize=True)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def convert_to_jpeg(filepath: str, jpeg_filepath: str, quality=JPEG_QUALITY):
+    """
+    Возвращает путь к картинке filepath в формате JPEG: сам filepath, если он уже JPEG,
+    или jpeg_filepath с переведённой картинкой. Если файл не картинка, возвращает None.
+    Выполняется в процессе пула ImageProcessor.
+    """
+    if os.path.exists(jpeg_filepath):
+        return jpeg_filepath
+    image = open_image(filepath)
+    if image is None:
+        return None
+    with image:
+        if image.format == 'JPEG':
+            return filepath
+        save_jpeg(image, jpeg_filepath, quality)
+    return jpeg_filepath
+
+
+def make_thumbnail(filepath: str, thumbnail_filepath: str, size=THUMBNAIL_SIZE, quality=JPEG_QUALITY):
+    """
+    Сохраняет в thumbnail_filepath уменьшенную (не больше size) копию картинки в JPEG.
+    Возвращает thumbnail_filepath или None, если файл не картинка.
+    Выполняется в процессе пула ImageProcessor.
+    """
+    if os.path.exists(thumbnail_filepath):
+        return thumbnail_filepath
+    image = open_image(filepath)
+    if image is None:
+        return None
+    with image:
+        image.thumbnail(size)
+        save_jpeg(image, thumbnail_filepath, quality)
+    return thumbnail_filepath
+
+
+class ImageProcessor:
+    __doc__ = '''
+    Обработка картинок в пуле процессов, чтобы работа с пикселями не занимала
+    потоки загрузки и интерфейс. Пул один на всю программу (get_image_processor)
+    и используется из циклов событий разных потоков загрузки. Одна и та же
+    картинка, которую уже обрабатывают, второй раз в пул не отправляется,
+    сколько бы книг на неё ни ссылалось.
+    Процессы запускаются через spawn: fork процесса с потоками Qt и загрузки
+    небезопасен, а на Windows и macOS spawn и так используется по умолчанию.
+    '''
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = self._create_executor()
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def convert_to_jpeg(self, filepath: str, jpeg_filepath: str):
+        """Асинхронный convert_to_jpeg."""
+        return await self._run_once(convert_to_jpeg, filepath, jpeg_filepath)
+
+    async def make_thumbnail(self, filepath: str, thumbnail_filepath: str, size=THUMBNAIL_SIZE):
+        """Асинхронный make_thumbnail."""
+        return await self._run_once(make_thumbnail, filepath, thumbnail_filepath, size)
+
+    async def _run_once(self, func, *args):
+        # Задачи пула общие для всех потоков, поэтому хранятся concurrent.futures.Future,
+        # а в цикл событий текущего потока заворачиваются через asyncio.wrap_future
+        key = (func.__name__, *args)
+        with self._lock:
+            task = self._tasks.get(key)
+            is_new_task = task is None
+            if is_new_task:
+                task = self._submit(func, *args)
+                self._tasks[key] = task
+        if is_new_task:
+            task.add_done_callback(lambda _: self._forget(key))
+        return await asyncio.wrap_future(task)
+
+    def _submit(self, func, *args):
+        try:
+            return self._executor.submit(func, *args)
+        except BrokenProcessPool:
+            # Упавший процесс ломает весь пул — на оставшееся время работы программы пул создаётся заново
+            self._executor.shutdown(wait=False)
+            self._executor = self._create_executor()
+            return self._executor.submit(func, *args)
+
+    def _forget(self, key) -> None:
+        with self._lock:
+            self._tasks.pop(key, None)
+
+    def close(self):
+        """Останавливает пул процессов."""
+        self._executor.shutdown(wait=True)
+
+
+def get_image_processor() -> ImageProcessor:
+    """Общий для всех потоков пул обработки картинок (создаётся при первом обращении)."""
+    global image_processor
+    with image_processor_lock:
+        if image_processor is None:
+            image_processor = ImageProcessor()
+    return image_processor
+
+
+def close_image_processor() -> None:
+    """Останавливает общий пул обработки картинок, если он создавался (при выходе из программы)."""
+    global image_processor
+    with image_processor_lock:
+        if image_processor is not None:
+            image_processor.close()
+            image_processor = None
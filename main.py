@@ -1,9 +1,13 @@
 __doc__ = '\nЗапуск графического интерфейса парсера информации\nс сайтов книжных интернет-магазинов.\n'
 
 import logging
+import multiprocessing
 import time
 import traceback
 
+import exporters
+import files
+import images
 import web
 from logger_manager import create_logger
 import main_ui
@@ -12,8 +16,19 @@ logger: logging.Logger
 
 
 if __name__ == '__main__':
+    # Нужно для пула процессов обработки картинок в собранной PyInstaller программе
+    multiprocessing.freeze_support()
     logger = create_logger(None, "logs.txt")
     web.logger = logger
+    settings = files.read_settings()
+    if settings['http_cache']:
+        web.enable_http_cache(files.get_http_cache_filepath(), ttl=settings['http_cache_ttl'])
+        logger.debug(f"Включён кэш страниц, срок свежести {settings['http_cache_ttl']} с")
+    exporters.enable_catalog(files.get_catalog_filepath())
+    unknown_formats = exporters.set_export_formats(settings['export_formats'])
+    if unknown_formats:
+        logger.debug(f"Неизвестные форматы выгрузки в настройках пропущены: {unknown_formats}")
+    logger.debug(f"Форматы выгрузки книг: {', '.join(exporters.books_export_formats)}")
     logger.debug("Парсер запущен. Версия 5.5")
 
     try:
@@ -22,3 +37,5 @@ if __name__ == '__main__':
         err_text = f"Ошибка в приложении парсера - '{exception}'\n" \
                    f"{traceback.format_exc()}"
         logger.debug(err_text)
+    finally:
+        images.close_image_processor()
@@ -126,7 +126,7 @@ class MainWindow(QMainWindow):
         self.fill_comboboxes(shop=BEBC_SHOP)
 
         # Vars to remember
-        self.studentsbook_soup_data_parsed = None
+        self.studentsbook_feed = None
         self.thread_data = None
 
         # MainWindow.setCentralWidget(self.centralwidget)
@@ -156,7 +156,7 @@ class MainWindow(QMainWindow):
 
             self.download_thread = studentsbook.StudentsbookPublishers()
             # self.download_thread.progress_set.connect(self.set_part_progress)
-            self.download_thread.soup_data_parsed.connect(self.load_students_soup_data_parsed)
+            self.download_thread.feed_loaded.connect(self.load_studentsbook_feed)
         elif shop == MY_SHOP:
             self.download_thread = my_shop.MyShopPublishers()
 
@@ -291,6 +291,9 @@ class MainWindow(QMainWindow):
         missing_images_dirpath = files.get_missing_images_dirpath(shop, publisher)
 
         try:
+            # Уже собранные книги my-shop узнаём до того, как Excel файл будет подготовлен заново
+            if shop == MY_SHOP:
+                books_index = files.get_books_index(excel_filepath)
             files.prepare_output_dirs_and_files(shop, publisher)
             # if not files.is_file_exists(excel_filepath):  # Start from scratch
             #     files.prepare_output_dirs_and_files(shop, publisher)
@@ -311,31 +314,31 @@ class MainWindow(QMainWindow):
             self.download_thread = bebc.BebcBooks(publisher, excel_filepath, images_dirpath,
                                                   missing_images_dirpath)  # , isbn)
         elif shop == STUDENTSBOOK_SHOP:
-            if not self.studentsbook_soup_data_parsed:
-                xml_dirpath = files.get_xml_dirpath(shop)
-                if files.is_file_exists(xml_dirpath):
+            if not self.studentsbook_feed:
+                feed_filepath = files.get_feed_filepath(shop)
+                if files.is_file_exists(feed_filepath):
                     sb = studentsbook.StudentsbookPublishers()
                     sb.parse_xml_file()
                     sb.get_total_offers()
                     sb.get_total_categories()
 
                     # content = files.get_correct_xml_content(shop)
-                    self.studentsbook_soup_data_parsed = [sb.offers, sb.categories_tag]
+                    self.studentsbook_feed = sb.feed
                 else:
-                    message = f"Не найден файл '{xml_dirpath}'. Сначала спарсите издательства."
+                    message = f"Не найден файл '{feed_filepath}'. Сначала спарсите издательства."
                     self.show_messagebox(message, warning=True)
                     self.set_widgets_enabled(True)
                     return
             # isbn = files.get_books_rows_from_excel(excel_filepath, 0)
 
             self.download_thread = studentsbook.StudentsbookBooks(
-                publisher, excel_filepath, images_dirpath, missing_images_dirpath, self.studentsbook_soup_data_parsed)
+                publisher, excel_filepath, images_dirpath, missing_images_dirpath, self.studentsbook_feed)
             # self.download_thread.progress_set.connect(self.set_studentsbook_progress)
             # self.download_thread.progress_update.connect(self.update_studentsbook_progress)
 
         elif shop == MY_SHOP:
             publisher_name, publisher_id = self.my_shop_publisher_id[self.publishers_combobox.currentIndex()]
-            ids = files.get_books_rows_from_excel(excel_filepath, 19)
+            ids = books_index['ids']
 
             self.download_thread = my_shop.MyShopBooks(publisher, excel_filepath, images_dirpath,
                                                        missing_images_dirpath, publisher_id, publisher_name, ids)
@@ -347,9 +350,9 @@ class MainWindow(QMainWindow):
         self.download_thread.finished.connect(self.finish_thread)
         self.download_thread.start()
 
-    def load_students_soup_data_parsed(self, soup_data_parsed):
-        """Загружает BeautifulSoup для магазина studentsbook."""
-        self.studentsbook_soup_data_parsed = soup_data_parsed
+    def load_studentsbook_feed(self, feed):
+        """Запоминает разобранную выгрузку магазина studentsbook."""
+        self.studentsbook_feed = feed
 
     def finish_thread(self):
         """Обрабатывает окончание работы дочернего потока."""
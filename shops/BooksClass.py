@@ -1,5 +1,6 @@
 __doc__ = '\nФункции для парсинга интернет-магазинов.\n'
 
+import asyncio
 import logging
 import os
 import shutil
@@ -9,7 +10,10 @@ import traceback
 # import requests.exceptions
 from PyQt6.QtCore import pyqtSignal, QThread
 
+import covers
+import exporters
 import files
+import images
 import web
 
 
@@ -19,6 +23,10 @@ import web
 
 # import cchardet
 
+# Метка конца элементов в очереди BooksDownloadThread.parse_in_workers
+END_OF_ITEMS = object()
+
+
 class MainBooksThread(QThread):
     __doc__ = 'Общий класс загрузки информации с сайтов.'
     progress_set = pyqtSignal(int)
@@ -31,12 +39,15 @@ class MainBooksThread(QThread):
     main_func: callable
     logger: logging.Logger
     session = None
+    MAX_CONCURRENCY = web.MAX_IN_FLIGHT_REQUESTS
 
     def __init__(self):
         super().__init__()
 
     def create_session(self, url, verify_ssl):
-        self.session = web.create_session_by_url(url, yandex=True, verify_ssl=verify_ssl)
+        # Сессия общая для всех издательств магазина, пул рассчитан на MAX_CONCURRENCY потоков
+        self.session = web.get_shop_session(url, self.MAX_CONCURRENCY, yandex=True, verify_ssl=verify_ssl,
+                                            cookies_filepath=files.get_cookies_filepath(self.shop_name))
 
 
 class PublishersDownloadThread(MainBooksThread):
@@ -48,6 +59,7 @@ class PublishersDownloadThread(MainBooksThread):
     def run(self):
         try:
             # self.logger.debug(f"Запущен сбор всех издательств для магазина '{self.shop_name}'")
+            web.retry_budget.reset()
 
             data = self.main_func()
 
@@ -74,6 +86,21 @@ class PublishersDownloadThread(MainBooksThread):
 class BooksDownloadThread(MainBooksThread):
     __doc__ = 'Общий класс загрузки информации о книгах с сайтов.'
     BASE_URL = ""
+    INITIAL_CONCURRENCY = web.MAX_IN_FLIGHT_REQUESTS
+    MAX_CONCURRENCY = 3 * web.MAX_IN_FLIGHT_REQUESTS
+    FLUSH_BATCH_SIZE = exporters.BOOKS_FLUSH_BATCH_SIZE
+    # Форматы выгрузки книг (None — из настроек, exporters.books_export_formats)
+    EXPORT_FORMATS = None
+    fetcher: web.AsyncFetcher = None
+    sink: exporters.BooksSink = None
+    cover_store: covers.CoverStore = None
+    # Обработка картинок (нужен Pillow): перевод в настоящий JPEG картинок, сохраняемых как .jpg,
+    # и уменьшенные копии размером не больше THUMBNAIL_SIZE в каталоге THUMBNAILS_DIRNAME (None — не делать)
+    CONVERT_IMAGES = True
+    THUMBNAIL_SIZE = None
+    THUMBNAILS_DIRNAME = 'Thumbnails'
+    image_processor: images.ImageProcessor = None
+    concurrency_controller: web.ConcurrencyController = None
 
     def __init__(self, *args, verify_ssl=True):
         super().__init__()
@@ -83,48 +110,132 @@ class BooksDownloadThread(MainBooksThread):
         self.excel_filepath = excel_filepath
         self.images_dirpath = images_dirpath
         self.missing_images_dirpath = missing_images_dirpath
+        self.thumbnails_dirpath = os.path.join(os.path.dirname(images_dirpath), self.THUMBNAILS_DIRNAME)
         self.verify_ssl = verify_ssl
 
     def run(self):
         try:
             start = time.time()
             # self.logger.debug(f"Запущен сбор книг издательства '{self.publisher}' для магазина '{self.shop_name}'")
+            web.retry_budget.reset()
+            web.parse_stats.reset()
             self.create_session(self.BASE_URL, self.verify_ssl)
 
-            books = self.main_func()
-            current_books_count = len(books)
-
-            # write to excel
-            if books:
-                files.write_books_to_excel(self.excel_filepath, books)
-                files.adjust_column_widths(self.excel_filepath)
-
+            # Книги выгружаются пачками по мере загрузки, выгрузки закрываются (а Excel собирается)
+            # в конце, в том числе если загрузка прервалась ошибкой
+            self.sink = exporters.BooksSink(self.excel_filepath, self.FLUSH_BATCH_SIZE, self.EXPORT_FORMATS,
+                                            exporters.books_catalog, self.shop_name, self.publisher)
+            try:
+                self.run_in_loop(self.main_func())
+            finally:
+                self.sink.close()
+            current_books_count = self.sink.count
+
+            web.save_session_cookies(self.session)
             self.result.emit({'books_count': current_books_count})
 
             time_diff = time.time() - start
 
             self.logger.debug(f"Сбор книг({current_books_count}) издательства '{self.publisher}' завершен за "
-                              f"{time_diff:.2f} секунд")
+                              f"{time_diff:.2f} секунд. Лимит одновременных запросов: "
+                              f"{self.concurrency_controller.limit}. Пулы соединений: "
+                              f"{web.get_pool_stats(self.session)}. Разбор страниц: {web.parse_stats}")
         except Exception as exception:
             err = Exception(f"Ошибка во время парсинга книг издательства '{self.publisher}' - '{exception}'\n"
                             f"{traceback.format_exc()}")
             self.logger.debug(err)
             self.error.emit(exception)
 
+    def run_in_loop(self, coroutine):
+        """Выполняет корутину загрузки книг в цикле событий этого потока."""
+        self.concurrency_controller = web.get_concurrency_controller(
+            self.shop_name, self.INITIAL_CONCURRENCY, self.MAX_CONCURRENCY)
+        self.fetcher = web.AsyncFetcher(controller=self.concurrency_controller)
+        self.cover_store = covers.get_cover_store()
+        self.cover_tasks = {}
+        # Какие картинки уже есть, узнаём один раз за запуск, а не проверкой каждого файла
+        self.existing_images = {dirpath: files.scan_filenames(dirpath)
+                                for dirpath in (self.images_dirpath, self.missing_images_dirpath, self.thumbnails_dirpath)}
+        if images.is_available() and (self.CONVERT_IMAGES or self.THUMBNAIL_SIZE):
+            # Пул процессов общий на всю программу и после сбора не останавливается
+            self.image_processor = images.get_image_processor()
+        try:
+            return asyncio.run(coroutine)
+        finally:
+            self.fetcher.close()
+
+    async def parse_in_workers(self, items, parse_task, workers_count=None) -> None:
+        """
+        Разбирает элементы items корутиной parse_task в workers_count задачах
+        (по умолчанию MAX_CONCURRENCY). Задачи не создаются заранее на каждую книгу,
+        а берут элементы по одному, поэтому их число не зависит от числа книг.
+        items — обычный или асинхронный итератор. Асинхронный (например, книги со страниц поиска)
+        читается отдельной задачей через очередь, поэтому следующая страница загружается,
+        пока разбираются книги с предыдущих.
+        """
+        workers_count = workers_count or self.MAX_CONCURRENCY
+        if not hasattr(items, '__aiter__'):
+            iterator = iter(items)
+
+            async def worker():
+                for item in iterator:
+                    await parse_task(item)
+
+            await asyncio.gather(*[worker() for _ in range(workers_count)])
+            return
+
+        queue = asyncio.Queue(maxsize=workers_count)
+
+        async def produce():
+            try:
+                async for item in items:
+                    await queue.put(item)
+            except Exception:
+                await queue.put(END_OF_ITEMS)
+                raise
+            await queue.put(END_OF_ITEMS)
+
+        async def queue_worker():
+            while True:
+                item = await queue.get()
+                if item is END_OF_ITEMS:
+                    # Возвращаем метку для остальных задач: место в очереди только что освободилось
+                    queue.put_nowait(END_OF_ITEMS)
+                    return
+                await parse_task(item)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            await asyncio.gather(*[queue_worker() for _ in range(workers_count)])
+        finally:
+            if not producer.done():
+                producer.cancel()
+        # Ошибка загрузки страниц поиска
+        await producer
+
     def get_image_url(self, book_details):
         return book_details['image_url']
 
     def get_book_cover_name(self, book_details):
         return book_details['isbn']
 
-    def download_book_cover(self, book_details):
+    async def download_book_cover(self, book_details):
         """ Загружает картинку обложки книги, если её нет. """
-        image_filepath = self.get_image_filepath(self.get_book_cover_name(book_details), book_details)
+        images_dirpath, image_filename = self.get_image_location(self.get_book_cover_name(book_details), book_details)
 
         if book_details['image_url']:
-            if not os.path.exists(image_filepath):
-                image_url = self.get_image_url(book_details)
-                web.download_file(image_url, image_filepath, self.session)
+            existing_images = self.existing_images[images_dirpath]
+            if image_filename not in existing_images:
+                # Имя занимается сразу, чтобы книги с тем же именем картинки не загружали её повторно
+                existing_images.add(image_filename)
+                try:
+                    blob_filepath = await self.fetch_cover(self.get_image_url(book_details))
+                    if self.image_processor is not None:
+                        blob_filepath = await self.process_cover(blob_filepath, images_dirpath, image_filename)
+                    covers.link_cover(blob_filepath, os.path.join(images_dirpath, image_filename))
+                except Exception:
+                    existing_images.discard(image_filename)
+                    raise
 
                 # Проверяем, если файл SVG, конвертируем в JPG
                 # if image_filepath.endswith(".svg"):
@@ -135,8 +246,53 @@ class BooksDownloadThread(MainBooksThread):
             self.logger.debug(f"WARNING: Книга isbn:{book_details['isbn']} по адресу {book_details['url']} "
                               f"не имеет картинки обложки.")
 
+    async def fetch_cover(self, image_url: str) -> str:
+        """
+        Получает картинку из общего хранилища обложек.
+        Одновременные запросы одного адреса (например, картинки «нет обложки») ждут одну загрузку.
+        """
+        task = self.cover_tasks.get(image_url)
+        if task is None:
+            task = asyncio.ensure_future(self.fetcher.fetch_cover(self.cover_store, image_url, self.session))
+            self.cover_tasks[image_url] = task
+        try:
+            return await task
+        except Exception:
+            self.cover_tasks.pop(image_url, None)
+            raise
+
+    async def process_cover(self, blob_filepath: str, images_dirpath: str, image_filename: str) -> str:
+        """
+        Переводит картинку в JPEG, если она сохраняется как .jpg, и делает уменьшенную копию
+        настоящей обложки. Возвращает путь к картинке, которую нужно положить в каталог издательства.
+        """
+        if self.CONVERT_IMAGES and image_filename.lower().endswith(('.jpg', '.jpeg')):
+            jpeg_filepath = await self.image_processor.convert_to_jpeg(
+                blob_filepath, self.cover_store.get_derived_filepath(blob_filepath, 'jpeg'))
+            if jpeg_filepath is None:
+                self.logger.debug(f"WARNING: Файл обложки {image_filename} издательства '{self.publisher}' "
+                                  f"не является картинкой.")
+                return blob_filepath
+            blob_filepath = jpeg_filepath
+
+        thumbnail_filename = os.path.splitext(image_filename)[0] + '.jpg'
+        existing_thumbnails = self.existing_images[self.thumbnails_dirpath]
+        if self.THUMBNAIL_SIZE and images_dirpath == self.images_dirpath and thumbnail_filename not in existing_thumbnails:
+            width, height = self.THUMBNAIL_SIZE
+            thumbnail_filepath = await self.image_processor.make_thumbnail(
+                blob_filepath, self.cover_store.get_derived_filepath(blob_filepath, f'thumbnail {width}x{height}'),
+                self.THUMBNAIL_SIZE)
+            if thumbnail_filepath is not None:
+                covers.link_cover(thumbnail_filepath, os.path.join(self.thumbnails_dirpath, thumbnail_filename))
+                existing_thumbnails.add(thumbnail_filename)
+        return blob_filepath
+
     def get_image_filepath(self, image_name: str, book_details) -> str:
         """Формирует путь к файлу с картинкой обложки книги."""
+        return os.path.join(*self.get_image_location(image_name, book_details))
+
+    def get_image_location(self, image_name: str, book_details) -> tuple:
+        """Каталог и имя файла с картинкой обложки книги."""
         extension = book_details['image_url'].split(".")[-1]
         if extension == "png":
             extension = "jpg"
@@ -144,7 +300,7 @@ class BooksDownloadThread(MainBooksThread):
 
         images_dirpath = self.missing_images_dirpath if missing_image else self.images_dirpath
         image_filename = f"{image_name}.{extension}"
-        return os.path.join(images_dirpath, image_filename)
+        return images_dirpath, image_filename
 
     # @staticmethod
     # def convert_svg_to_jpg(input_svg_path, output_jpg_path):
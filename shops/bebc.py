@@ -2,9 +2,8 @@ __doc__ = '\nФункции для парсинга интернет-магаз
 
 import math
 import re
-import time
+import traceback
 from contextlib import suppress
-from threading import Thread
 from urllib.parse import quote
 
 import exceptions
@@ -15,6 +14,13 @@ from logger_manager import create_logger
 SHOP = 'bebc.co.uk'
 BASE_URL = f'https://www.{SHOP}'
 MAX_BOOKS_PER_PAGE = 18
+REQUESTS_PER_SECOND = 5
+BURST_SIZE = 18
+
+web.set_rate_limit(SHOP, REQUESTS_PER_SECOND, BURST_SIZE)
+
+# Блоки страниц поиска и книги, которые нужны парсеру
+BOOK_PAGE_STRAINER = web.make_class_strainer('listing', 'product-item', 'product-detail')
 
 
 class BebcPublishers(PublishersDownloadThread):
@@ -46,6 +52,8 @@ class BebcPublishers(PublishersDownloadThread):
 
 class BebcBooks(BooksDownloadThread):
     __doc__ = 'Класс потока загрузки информации о книгах с сайта bebc.co.uk.'
+    INITIAL_CONCURRENCY = MAX_BOOKS_PER_PAGE
+    MAX_CONCURRENCY = 3 * MAX_BOOKS_PER_PAGE
 
     def __init__(self, publisher, excel_filepath, images_dirpath, missing_images_dirpath):  # , isbn):
         super().__init__(publisher, excel_filepath, images_dirpath, missing_images_dirpath)
@@ -59,75 +67,75 @@ class BebcBooks(BooksDownloadThread):
         # # Own variables
         # self.isbn = isbn
 
-    def _run(self):
+    async def _run(self):
         """
         Запускает поток загрузки информации о книгах по выбранному издательству
         с сайта bebc.co.uk.
         """
 
         # self.session = web.create_session_by_url(BASE_URL)
-        books = []
-
-        first_soup = self.get_soup_from_search_page(1)
+        first_soup = await self.get_soup_from_search_page(1)
         books_count = self.get_total_books_amount(first_soup)
 
         # IF only 1 book in a publisher, it opens this book's page
         if books_count == 1:
             self.progress_update.emit(1)
-            self.parse_book(first_soup, books)
+            await self.parse_book(first_soup)
         # More than 1 book
         else:
             pages_amount = math.ceil(books_count / MAX_BOOKS_PER_PAGE)
             self.progress_set.emit(books_count)
 
-            # Parse throw all pages
-            for page in range(1, pages_amount + 1):
-                # Get soup from page (first page is already parsed)
-                soup = first_soup if page == 1 else self.get_soup_from_search_page(page)
-
-                product_items = soup.find_all(class_='product-item')
-                if not product_items:
-                    break  # possible end or some error
+            # Books of all pages go to the same workers, next pages load while books are parsed
+            await self.parse_in_workers(self.iter_product_items(first_soup, pages_amount), self.parse_book_task)
 
-                # A thread for every book on page
-                threads_amount = len(product_items)
-                threads = []
+    async def iter_product_items(self, first_soup, pages_amount):
+        """Элементы книг со всех страниц поиска по порядку."""
+        # Parse throw all pages
+        for page in range(1, pages_amount + 1):
+            # Get soup from page (first page is already parsed)
+            soup = first_soup if page == 1 else await self.get_soup_from_search_page(page)
 
-                for i in range(threads_amount):
-                    threads.append(Thread(target=self.parse_books_thread, args=(product_items[i], books, i)))
-                    threads[i].start()
+            product_items = soup.find_all(class_='product-item')
+            if not product_items:
+                break  # possible end or some error
 
-                [thread.join() for thread in threads]
+            for product_item in product_items:
+                yield product_item
 
-        return books
-
-    def get_soup_from_search_page(self, page_number):
+    async def get_soup_from_search_page(self, page_number):
         base_search = f'{BASE_URL}/categories/advancedsearch'
         encoded_publisher = quote(self.publisher, safe='')
         page_url = f"{base_search}?publisher={encoded_publisher}&page={page_number}"
-        response, soup = web.get_html_page(page_url, session=self.session, with_soup=True)
+        response, soup = await self.fetcher.get_html_page(page_url, session=self.session, with_soup=True,
+                                                          parser=web.FAST_HTML_PARSER,
+                                                          parse_only=BOOK_PAGE_STRAINER)
         return soup
 
-    def parse_book(self, soup, books: list):
+    async def parse_book(self, soup):
         book_details = self.extract_book_details(soup)
         if book_details:
-            books.append(book_details)
-            self.download_book_cover(book_details)
-
-    def parse_books_thread(self, product_item, books, i):
-        time.sleep(0.2 * i)  # for threads to start in order
-
-        a_tag = product_item.find('a')
-        if not a_tag:
-            # debug to log
-            self.logger.debug(f"ERROR: [{SHOP}] Не найден тег 'a' в product_item: {product_item}")
-        else:
-            book_url = a_tag.get('href')
-            book_response, book_soup = web.get_html_page(book_url, session=self.session, with_soup=True)
+            self.sink.add(book_details)
+            await self.download_book_cover(book_details)
+
+    async def parse_book_task(self, product_item):
+        try:
+            a_tag = product_item.find('a')
+            if not a_tag:
+                # debug to log
+                self.logger.debug(f"ERROR: [{SHOP}] Не найден тег 'a' в product_item: {product_item}")
+            else:
+                book_url = a_tag.get('href')
+                book_response, book_soup = await self.fetcher.get_html_page(
+                    book_url, session=self.session, with_soup=True, parser=web.FAST_HTML_PARSER,
+                    parse_only=BOOK_PAGE_STRAINER)
 
-            self.parse_book(book_soup, books)
+                await self.parse_book(book_soup)
+        except Exception as e:
+            self.logger.debug(f"ERROR: Ошибка во время парсинга книги издательства '{self.publisher}' - '{e}'\n"
+                              f"{traceback.format_exc()}")
 
-        self.progress_update.emit(len(books))
+        self.progress_update.emit(self.sink.count)
 
     # def _run_threading(self):
 
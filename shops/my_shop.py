@@ -1,9 +1,7 @@
 __doc__ = '\nФункции для парсинга интернет-магазина my-shop.ru.\n'
 
 import math
-import time
 import traceback
-from threading import Thread
 
 import lxml.html
 import lxml.html.clean
@@ -16,6 +14,10 @@ from logger_manager import create_logger
 SHOP = 'my-shop.ru'
 BASE_URL = f"https://api.{SHOP}/cgi-bin/shop2.pl"
 MAX_BOOKS_PER_PAGE = 40
+REQUESTS_PER_SECOND = 10
+BURST_SIZE = 40
+
+web.set_rate_limit(SHOP, REQUESTS_PER_SECOND, BURST_SIZE)
 
 
 class MyShopPublishers(PublishersDownloadThread):
@@ -116,6 +118,8 @@ class MyShopPublishers(PublishersDownloadThread):
 
 class MyShopBooks(BooksDownloadThread):
     __doc__ = 'Класс потока загрузки информации о книгах с сайта my-shop.ru.'
+    INITIAL_CONCURRENCY = MAX_BOOKS_PER_PAGE
+    MAX_CONCURRENCY = 2 * MAX_BOOKS_PER_PAGE
 
     def __init__(self, publisher, excel_filepath, images_dirpath, missing_images_dirpath,
                  publisher_id, publisher_name, ids):
@@ -135,30 +139,32 @@ class MyShopBooks(BooksDownloadThread):
         self.session = None
         self.cleaner = lxml.html.clean.Cleaner(style=True)
 
-    def _run(self):
+    async def _run(self):
         """Запускает поток загрузки информации о книгах по выбранному издательству с сайта."""
         # try:
 
         # Parse books
         params = {'q': 'producer', 'id': self.publisher_id, 'sort': 'a', 'page': '1'}
-        response = web.get_html_page(BASE_URL, params=params, session=self.session)
+        response = await self.fetcher.get_html_page(BASE_URL, params=params, session=self.session)
         total_books_amount = response.json()['meta']['total']
         total_pages = math.ceil(total_books_amount / MAX_BOOKS_PER_PAGE)
         # print(f"Collected total books: {total_books_amount}, total pages: {total_pages}")
 
         self.progress_set.emit(total_books_amount)
 
-        books_on_page = response.json()['products']
-        books = []
-        self.parse_books(books_on_page, books)
+        # Books of all pages go to the same workers, next pages load while books are parsed
+        await self.parse_in_workers(self.iter_book_links(response, params, total_pages), self.parse_book_task)
+
+    async def iter_book_links(self, first_response, params, total_pages):
+        """Ссылки на книги со всех страниц издательства по порядку."""
+        for book_link in first_response.json()['products']:
+            yield book_link
 
         for page in range(2, total_pages + 1):
             params['page'] = page
-            response = web.get_html_page(BASE_URL, params=params, session=self.session)
-            books_on_page = response.json()['products']
-            self.parse_books(books_on_page, books)
-
-        return books
+            response = await self.fetcher.get_html_page(BASE_URL, params=params, session=self.session)
+            for book_link in response.json()['products']:
+                yield book_link
 
     # def parse_books_old(self, books_on_page, page):
     #     books = []
@@ -199,38 +205,21 @@ class MyShopBooks(BooksDownloadThread):
     #
     #     return books
 
-    def parse_books(self, books_on_page, books):
-        # A thread for every book on page
-        threads_amount = len(books_on_page)
-        threads = []
-
-        for i in range(threads_amount):
-            threads.append(Thread(target=self.parse_books_thread, args=(books, books_on_page[i], i)))
-            threads[i].start()
-
-        [thread.join() for thread in threads]
-
-        return books
-
-    def parse_books_thread(self, books, book_link, i):
-        time.sleep(0.2 * i)  # for threads to start in order
-
+    async def parse_book_task(self, book_link):
         try:
             product_id = book_link['product_id']
 
             params = {'q': 'product', 'id': product_id}
-            response = web.get_html_page(BASE_URL, params=params, session=self.session)
+            response = await self.fetcher.get_html_page(BASE_URL, params=params, session=self.session)
             product_info = response.json()['product']
 
             # parse book json
             book_details = self.get_book_details(product_info)
-            books.append(book_details)
-            # remaking get_book_cover_name for return needed img_path
-            self.get_book_cover_name = lambda _: book_details['isbn'].strip() or product_id
-            self.download_book_cover(book_details)
+            self.sink.add(book_details)
+            await self.download_book_cover(book_details)
 
             # emit book
-            self.progress_update.emit(len(books))
+            self.progress_update.emit(self.sink.count)
 
         except Exception as e:
             err_text = Exception(f"ERROR: Ошибка во время парсинга книг издательства '{self.publisher}' - '{e}'\n"
@@ -239,6 +228,9 @@ class MyShopBooks(BooksDownloadThread):
             # self.error.emit(err_text)
             # raise e
 
+    def get_book_cover_name(self, book_details):
+        return book_details['isbn'].strip() or book_details['ID']
+
     def get_book_details(self, product_info: dict) -> dict:
         """Получает детальную информацию о книге из содержимого книги в магазине."""
 
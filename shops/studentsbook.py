@@ -2,13 +2,13 @@ __doc__ = '\nФункции для парсинга интернет-магаз
 
 import os
 import re
-import threading
-import time
+import sys
 import traceback
 from urllib.parse import urlsplit
 
 import cyrtranslit
 import requests.exceptions
+from lxml import etree
 from PyQt6.QtCore import pyqtSignal
 
 import exceptions
@@ -20,11 +20,171 @@ from logger_manager import create_logger
 SHOP = 'studentsbook.net'
 BASE_URL = f'https://{SHOP}'
 find_url = BASE_URL + "/catalog/?q={{}}&s=%D0%9F%D0%BE%D0%B8%D1%81%D0%BA"  # &s=Поиск
+FEED_URL = f"{BASE_URL}/bitrix/catalog_export/yandex_yml.php"
+FEED_TAGS = ('category', 'offer')
+REQUESTS_PER_SECOND = 8
+BURST_SIZE = 20
+
+web.set_rate_limit(SHOP, REQUESTS_PER_SECOND, BURST_SIZE)
+
+# Блоки страниц книги и поиска, которые нужны парсеру
+BOOK_PAGE_STRAINER = web.make_class_strainer('info_item', 'props_list', 'detail_text', 'slides',
+                                             'catalog block search')
+
+
+def iter_feed_elements(feed_filepath: str):
+    """
+    Читает YML-выгрузку магазина потоком (lxml.etree.iterparse) и по очереди отдаёт
+    элементы <category> и <offer>. Кодировку (windows-1251) lxml берёт из объявления XML.
+    Отданный элемент очищается сразу после обработки, поэтому всё дерево в памяти не строится.
+    """
+    context = etree.iterparse(feed_filepath, events=('end',), tag=FEED_TAGS, huge_tree=True)
+    for _, element in context:
+        yield element
+        element.clear(keep_tail=True)
+        # Удаляем уже обработанные соседние элементы, чтобы не копились пустые узлы
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    del context
+
+
+def get_element_text(element) -> str:
+    """Текст элемента вместе с текстом вложенных элементов (как .text у BeautifulSoup)."""
+    return ''.join(element.itertext())
+
+
+# Полей предложения выгрузки, которые читает Offer (по месту в <offer>)
+OFFER_FIELDS_COUNT = 14
+
+
+class Offer:
+    __doc__ = '''
+    Предложение выгрузки: только поля, нужные для загрузки книги
+    (см. StudentsbookBooks.extract_book_details_xml). Повторяющиеся
+    строки (издательство, категория, валюта, вид) интернированы.
+    '''
+    __slots__ = ('url', 'price', 'currency', 'category_id', 'image_url', 'authors', 'name',
+                 'publisher', 'year', 'isbn', 'type', 'pages', 'description')
+
+    def __init__(self, children: list):
+        """
+        children — пары (тег, текст) дочерних элементов <offer> в порядке выгрузки.
+        Адрес и издательство берутся по тегу, остальные поля — по месту в предложении;
+        отсутствующие поля равны None.
+        """
+        values = [text for tag, text in children]
+        values += [None] * (OFFER_FIELDS_COUNT - len(values))
+        tags = dict(reversed(children))
+
+        self.url = tags.get('url', '')
+        self.price = values[1]
+        self.currency = intern_text(values[2])
+        self.category_id = intern_text(values[3])
+        self.image_url = values[4]
+        self.authors = values[5]
+        self.name = values[6]
+        self.publisher = intern_text(tags.get('publisher', ''))
+        self.year = intern_text(values[9])
+        self.isbn = values[10]
+        self.type = intern_text(values[11])
+        self.pages = values[12]
+        self.description = values[13]
+
+
+def intern_text(text):
+    """Интернирует строку, чтобы одинаковые значения в предложениях хранились один раз."""
+    return sys.intern(text) if text is not None else None
+
+
+def build_category_paths(categories: list) -> dict:
+    """
+    Таблица id категории -> полное название «Родитель-Потомок-Лист».
+    Каждая категория проходится один раз: пути родителей запоминаются и переиспользуются.
+    Категории с оборванной или зацикленной цепочкой родителей в таблицу не попадают.
+    """
+    categories_by_id = {}
+    for category in categories:
+        categories_by_id.setdefault(category['id'], category)
+
+    paths = {}
+    for category_id in categories_by_id:
+        chain, visited = [], set()
+        current_id = category_id
+        while current_id is not None and current_id not in paths:
+            if current_id in visited or current_id not in categories_by_id:
+                chain = None
+                break
+            visited.add(current_id)
+            chain.append(current_id)
+            current_id = categories_by_id[current_id]['parentId']
+        if chain is None:
+            continue
+
+        path = paths[current_id] if current_id is not None else None
+        for chain_id in reversed(chain):
+            text = categories_by_id[chain_id]['text']
+            path = text if path is None else path + "-" + text
+            paths[chain_id] = path
+    return paths
+
+
+def make_publisher_key(publisher: str) -> str:
+    """Ключ издательства без учёта регистра: так в выгрузке сравниваются названия издательств."""
+    return publisher.casefold()
+
+
+class StudentsbookFeed:
+    __doc__ = '''
+    Разобранная выгрузка магазина: предложения (Offer) и категории.
+    Не зависит от дерева XML, поэтому загружается один раз и передаётся
+    всем потокам загрузки книг издательств. Номера предложений каждого
+    издательства и полные названия категорий собираются при загрузке,
+    поэтому ни выбор предложений издательства, ни название категории книги
+    не перебирают всю выгрузку.
+    '''
+
+    def __init__(self, offers: list, categories: list):
+        self.offers = offers
+        self.categories = categories
+        self.category_paths = build_category_paths(categories)
+        self.publisher_offer_ids = {}
+        for offer_id, offer in enumerate(offers):
+            self.publisher_offer_ids.setdefault(make_publisher_key(offer.publisher), []).append(offer_id)
+
+    def get_publisher_offers(self, publisher: str) -> list:
+        """Предложения издательства publisher (без учёта регистра) в порядке выгрузки."""
+        offers = self.offers
+        return [offers[offer_id] for offer_id in self.publisher_offer_ids.get(make_publisher_key(publisher), ())]
+
+    def get_publisher_counts(self) -> dict:
+        """
+        Число предложений каждого издательства. Издательства, различающиеся только регистром,
+        считаются одним и называются так, как впервые встретились в выгрузке.
+        """
+        offers = self.offers
+        return {offers[offer_ids[0]].publisher: len(offer_ids)
+                for publisher_key, offer_ids in self.publisher_offer_ids.items() if publisher_key}
+
+    @classmethod
+    def from_file(cls, feed_filepath: str):
+        """
+        Читает выгрузку за один проход: предложения — в Offer, категории —
+        в словари с id, parentId и text.
+        """
+        offers, categories = [], []
+        for element in iter_feed_elements(feed_filepath):
+            if element.tag == 'offer':
+                offers.append(Offer([(child.tag, get_element_text(child))
+                                     for child in element if isinstance(child.tag, str)]))
+            else:
+                categories.append({'id': element.get('id'), 'parentId': element.get('parentId'),
+                                   'text': get_element_text(element)})
+        return cls(offers, categories)
 
 
 class StudentsbookPublishers(PublishersDownloadThread):
     __doc__ = 'Класс для потока загрузки издательств с сайта studentsbook.net.'
-    soup_data_parsed = pyqtSignal(list)
+    feed_loaded = pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
@@ -35,12 +195,12 @@ class StudentsbookPublishers(PublishersDownloadThread):
         self.logger = create_logger(SHOP)
 
         # Own variables
-        self.total_publishers = self.publishers = self.publishers_tag = None
+        self.total_publishers = self.publishers = self.feed = self.offers = self.feed_categories = None
         # self.soup = studentsbook_soup
 
     def _run(self):
         """Загружает список издательств с сайта studentsbook.net."""
-        self.session = web.create_session_by_url(BASE_URL, yandex=True, verify_ssl=False)
+        self.create_session(BASE_URL, verify_ssl=False)
 
         self.progress_update.emit(1)
         self.load_site_xml()
@@ -57,55 +217,41 @@ class StudentsbookPublishers(PublishersDownloadThread):
         if self.offers_count == 0:
             raise exceptions.WebsiteStructureError(f"На сайте {SHOP} не найдены издательства.")
 
-        self.soup_data_parsed.emit([self.offers, self.categories_tag])
+        self.feed_loaded.emit(self.feed)
 
         return [self.total_publishers_info]
 
     def get_total_offers(self):
-        self.offers = self.soup.find_all("offer")
         self.offers_count = len(self.offers)
 
     def get_total_categories(self):
-        self.categories_tag = self.soup.find_all("category")
-        self.categories = tuple([c.text for c in self.categories_tag])
+        self.categories = tuple([c['text'] for c in self.feed_categories])
         self.total_categories = set(c for c in self.categories)
 
     def parse_xml_file(self):
-        content = files.get_correct_xml_content(SHOP)
-        self.soup = web.get_soup_from_content(content, parser='xml')
+        self.feed = StudentsbookFeed.from_file(files.get_feed_filepath(SHOP))
+        self.offers, self.feed_categories = self.feed.offers, self.feed.categories
 
     def get_total_publishers(self):
-        self.publishers_tag = [o.find("publisher") for o in self.offers if o.find("publisher").text]
-        self.publishers = tuple([p.text for p in self.publishers_tag])
-
-        # self.total_publishers = set(p for p in self.publishers)
-        # self.total_publishers_info = sorted([f"{p} [{self.publishers.count(p)}]" for p in self.total_publishers])
-        # return 0
-
-        pub_set = dict()
-        for p in self.publishers:
-            if p.lower() not in [k.lower() for k in pub_set.keys()]:
-                pub_set.update({p: 1})
-            else:
-                for k in pub_set.keys():
-                    if p.lower() == k.lower():
-                        pub_set[k] += 1
+        # Счётчики собраны индексом издательств за тот же проход, которым читалась выгрузка
+        pub_set = self.feed.get_publisher_counts()
+        self.publishers = tuple(pub_set)
 
         self.total_publishers = sorted(pub_set)
         self.total_publishers_info = [f"{n} [{a}]" for n, a in list(sorted(pub_set.items()))]
 
     def load_site_xml(self):
         # load main XML file
-        # request = web.get_html_page("https://studentsbook.net/robots.txt", headers=headers)
-        request = web.get_html_page(f"{BASE_URL}/bitrix/catalog_export/yandex_yml.php", session=self.session)
-
-        files.save_xml_to_file(SHOP, request)
+        # Выгрузка пишется на диск по частям и как есть, без перекодирования
+        web.download_file(FEED_URL, files.get_feed_filepath(SHOP), self.session)
 
 
 class StudentsbookBooks(BooksDownloadThread):
     __doc__ = 'Класс потока загрузки информации о книгах с сайта studentsbook.net.'
+    INITIAL_CONCURRENCY = 20
+    MAX_CONCURRENCY = 60
 
-    def __init__(self, publisher, excel_filepath, images_dirpath, missing_images_dirpath, soup_data_parsed):
+    def __init__(self, publisher, excel_filepath, images_dirpath, missing_images_dirpath, feed: StudentsbookFeed):
         super().__init__(publisher, excel_filepath, images_dirpath, missing_images_dirpath, verify_ssl=False)
 
         # Superclass variables
@@ -115,8 +261,8 @@ class StudentsbookBooks(BooksDownloadThread):
         self.logger = create_logger(SHOP)
 
         # Own variables
-        self.offers, self.categories_tag = soup_data_parsed
-        # self.soup = soup_data_parsed
+        self.feed = feed
+        self.offers, self.feed_categories = feed.offers, feed.categories
         # self.isbn = isbn
 
         self.session = None
@@ -124,75 +270,59 @@ class StudentsbookBooks(BooksDownloadThread):
         self.MAX_RETRY_ATTEMPTS = 50
         self.LOG_FILE_PATH = "parser.log"
 
-    def _run(self):
+    async def _run(self):
         """
         Запускает поток загрузки информации о книгах по выбранному издательству
         с сайта studentsbook.net.
         """
         # progress_values = {'subcatalog_number': 0, 'book_number': 0}
 
-        self.get_offers_by_publisher(self.publisher.lower())
+        self.get_offers_by_publisher(self.publisher)
 
         self.progress_set.emit(self.offers_by_publisher_count)
 
-        books = self.parse_books()
-
-        return books
-
-    def parse_books(self):
-        books = []
-        # A thread for every N book
-        threads_amount = min(20, self.offers_by_publisher_count)
-        threads = []
-
-        for i in range(threads_amount):
-            threads.append(threading.Thread(target=self.parse_books_thread, args=(i, threads_amount, books)))
-            threads[i].start()
-
-        [t.join() for t in threads]
-
-        return books
-
-    def parse_books_thread(self, thread_number, threads_amount, books):
-        time.sleep(thread_number / 2)  # for threads to start in order
+        await self.parse_books()
 
-        for i, offer in enumerate(self.offers_by_publisher):
-            if i % threads_amount != thread_number:
-                continue
+    async def parse_books(self):
+        # Книги разбирают MAX_CONCURRENCY задач, сколько бы книг ни было у издательства
+        await self.parse_in_workers(self.offers_by_publisher, self.parse_book_task)
 
-            try:
-                xml_book = self.extract_book_details_xml(offer)
-                # if xml_book['isbn'] not in self.isbn:  # Only for new books
-                raw_url = offer.find("url").text
-
-                # get book details
-                book_details = self.try_to_get_book_details(raw_url, xml_book)
-                if not book_details:
-                    # No such a book
-                    self.logger.debug(f"WARNING: Книга isbn:{xml_book['isbn']} по адресу {raw_url} "
-                                      f"не найдена на сайте. Хотя она указана в XML файле.")
-                    continue
-
-                books.append(book_details)
-                if book_details.get("url") is None:
-                    book_details["url"] = raw_url
-
-                if not book_details.get("image_url"):
-                    book_details["image_url"] = "https://studentsbook.net/bitrix/templates/aspro_mshop/images/no_photo_medium.png"
-                    book_details["missing image"] = True
-
-                self.download_book_cover(book_details)
-
-                self.progress_update.emit(len(books))
-            except Exception as e:
-                # if books:
-                #     files.write_books_to_excel(self.excel_filepath, books)
-                err_text = f"ERROR: Ошибка при загрузке книги {xml_book['isbn']} по адресу {raw_url}. \n" \
-                           f"Ошибка: {traceback.format_exc()}"
-                self.logger.debug(f"RETRY Книга {xml_book['isbn']} адрес {raw_url}")
-                self.logger.debug(err_text)
-                # self.error.emit(e)
-                # raise e
+    async def parse_book_task(self, offer):
+        xml_book, raw_url = {}, None
+        try:
+            xml_book = self.extract_book_details_xml(offer)
+            # if xml_book['isbn'] not in self.isbn:  # Only for new books
+            raw_url = offer.url
+
+            # get book details
+            book_details = await self.try_to_get_book_details(raw_url, xml_book)
+            if not book_details:
+                # No such a book
+                self.logger.debug(f"WARNING: Книга isbn:{xml_book['isbn']} по адресу {raw_url} "
+                                  f"не найдена на сайте. Хотя она указана в XML файле.")
+                return
+
+            if book_details.get("url") is None:
+                book_details["url"] = raw_url
+
+            if not book_details.get("image_url"):
+                book_details["image_url"] = "https://studentsbook.net/bitrix/templates/aspro_mshop/images/no_photo_medium.png"
+                book_details["missing image"] = True
+
+            self.sink.add(book_details)
+
+            await self.download_book_cover(book_details)
+
+            self.progress_update.emit(self.sink.count)
+        except Exception as e:
+            # if books:
+            #     files.write_books_to_excel(self.excel_filepath, books)
+            err_text = f"ERROR: Ошибка при загрузке книги {xml_book.get('isbn')} по адресу {raw_url}. \n" \
+                       f"Ошибка: {traceback.format_exc()}"
+            self.logger.debug(f"RETRY Книга {xml_book.get('isbn')} адрес {raw_url}")
+            self.logger.debug(err_text)
+            # self.error.emit(e)
+            # raise e
 
     def get_image_url(self, book_details):
         image_url = book_details['image_url']
@@ -203,10 +333,10 @@ class StudentsbookBooks(BooksDownloadThread):
             image_url = "/".join(splited)
         return image_url
 
-    def try_to_get_book_details(self, raw_url, xml_book):
+    async def try_to_get_book_details(self, raw_url, xml_book):
         try:  # raw url
             # print(f"xml_book['description']: {xml_book['description']}")
-            book_details = self.get_book_details_url(raw_url)
+            book_details = await self.get_book_details_url(raw_url)
             # print(f"book_details['description']: {book_details.get('description')}")
         except requests.exceptions.HTTPError as e:
             authors_raw = cyrtranslit.to_latin(xml_book["authors"], "ru")
@@ -219,64 +349,58 @@ class StudentsbookBooks(BooksDownloadThread):
             authors_url = BASE_URL + new_path
 
             try:  # with author name
-                book_details = self.get_book_details_url(authors_url)
+                book_details = await self.get_book_details_url(authors_url)
             except requests.exceptions.HTTPError as e:
                 # find in site
-                last_chance_url = self.find_book_url_by_xml(xml_book)
+                last_chance_url = await self.find_book_url_by_xml(xml_book)
                 if last_chance_url:
                     last_chance_url = last_chance_url + "?" + urlsplit(raw_url).query
-                    book_details = self.get_book_details_url(last_chance_url)
+                    book_details = await self.get_book_details_url(last_chance_url)
                 else:  # No such a book
                     return False
 
         return book_details
 
     def get_offers_by_publisher(self, publisher):
-        self.offers_by_publisher = [o for o in self.offers if o.find("publisher").text.lower() == publisher]
+        self.offers_by_publisher = self.feed.get_publisher_offers(publisher)
         self.offers_by_publisher_count = len(self.offers_by_publisher)
 
-    def get_category_recursion(self, category_id):
-        """ Рекурсивно получает полное название категории """
-        cat = [c for c in self.categories_tag if c['id'] == str(category_id)][0]
-        try:
-            parent = cat['parentId']
-            return self.get_category_recursion(parent) + "-" + cat.text
-        except KeyError:
-            return cat.text
+    def get_category_path(self, category_id):
+        """ Получает полное название категории из таблицы выгрузки """
+        return self.feed.category_paths[str(category_id)]
+
+    def extract_book_details_xml(self, offer: Offer):
+        """ Извлекает информацию о книге из предложения <offer> выгрузки """
+        if offer.pages is None:
+            raise IndexError(f"В предложении выгрузки {offer.url} не хватает полей")
 
-    def extract_book_details_xml(self, offer):
-        """ Извлекает информацию о книге из тега <offer> """
         book_details = {}
-        exists = [c for c in offer.contents if c.text != "\n"]
-
-        # book_details["url"] = exists[0].text
-        book_details["price"] = exists[1].text
-        book_details["currency"] = exists[2].text
-        book_details["category"] = self.get_category_recursion(exists[3].text)
-        book_details["image_url"] = exists[4].text
-        book_details["authors"] = exists[5].text
-        book_details["name"] = exists[6].text
-        book_details["publisher"] = exists[7].text
-        # book_details["series"] = exists[8].text
-        book_details["year"] = exists[9].text
-        book_details["isbn"] = exists[10].text
-        # book_details["barcode"] = exists[11].text
-        # book_details["age_category"] = exists[12].text
-        book_details["type"] = exists[11].text
-        book_details["pages"] = exists[12].text
-        try:
-            book_details["description"] = exists[13].text
-        except IndexError:
-            book_details["description"] = " "
+        # book_details["url"] = offer.url
+        book_details["price"] = offer.price
+        book_details["currency"] = offer.currency
+        book_details["category"] = self.get_category_path(offer.category_id)
+        book_details["image_url"] = offer.image_url
+        book_details["authors"] = offer.authors
+        book_details["name"] = offer.name
+        book_details["publisher"] = offer.publisher
+        # book_details["series"] = exists[8]
+        book_details["year"] = offer.year
+        book_details["isbn"] = offer.isbn
+        # book_details["barcode"] = exists[11]
+        # book_details["age_category"] = exists[12]
+        book_details["type"] = offer.type
+        book_details["pages"] = offer.pages
+        book_details["description"] = offer.description if offer.description is not None else " "
 
         book_details['missing image'] = False
 
         return book_details
 
-    def find_book_url_by_xml(self, xml_book):
+    async def find_book_url_by_xml(self, xml_book):
         url = find_url.replace("{{}}", xml_book['isbn'])
 
-        req, soup = web.get_html_page(url, session=self.session, with_soup=True)
+        req, soup = await self.fetcher.get_html_page(url, session=self.session, with_soup=True,
+                                                     parser=web.FAST_HTML_PARSER, parse_only=BOOK_PAGE_STRAINER)
 
         block_search = soup.find("div", "catalog block search")
         if not block_search:
@@ -289,12 +413,13 @@ class StudentsbookBooks(BooksDownloadThread):
         link = BASE_URL + book_links[1]['href']
         return link
 
-    def get_book_details_url(self, url: str) -> dict:
+    async def get_book_details_url(self, url: str) -> dict:
         """
         Получает детальную информацию о книге из содержимого
         html-страницы книги в магазине studentsbook.net.
         """
-        req, soup = web.get_html_page(url, session=self.session, with_soup=True)
+        req, soup = await self.fetcher.get_html_page(url, session=self.session, with_soup=True,
+                                                     parser=web.FAST_HTML_PARSER, parse_only=BOOK_PAGE_STRAINER)
         info_item = soup.find("div", 'info_item')
         if not info_item:
             return {}
@@ -1,43 +1,182 @@
 __doc__ = '\nФункции работы с интернетом.\n'
 
+import asyncio
+import collections
+import email.utils
+import functools
+import http.cookiejar
 import logging
 import os
+import re
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from urllib.parse import unquote, urlsplit
 
 import requests
 import urllib3
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from urllib3.connection import HTTPConnection
+
+from http_cache import HttpCache
+from http_replay import FixtureStore, MODE_OFF, MODE_RECORD, MODE_REPLAY
 
 
 # Suppress only the single warning from urllib3.
 urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
 
 logger: logging.Logger
+http_cache: HttpCache = None
+http_mode = MODE_OFF
+fixture_store: FixtureStore = None
 CONNECTION_ATTEMPTS_COUNT = 10
 DELAY_BETWEEN_CONNECTION_ATTEMPTS = 10
 MAX_TIMEOUT = 40
+MAX_BACKOFF_DELAY = 120
+REQUEST_DEADLINE = 600
+RETRY_BUDGET = 1000
+MAX_IN_FLIGHT_REQUESTS = 20
+SESSION_POOL_SIZE = MAX_IN_FLIGHT_REQUESTS
+SESSION_POOL_HOSTS = 4
+KEEP_ALIVE_IDLE = 30
+KEEP_ALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    KEEP_ALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEP_ALIVE_IDLE))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+FAST_HTML_PARSER = 'lxml'
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.validator'
+LATENCY_SMOOTHING = 0.2
+LATENCY_TOLERANCE = 2.5
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 2
 
+RESPONSE_OK, RESPONSE_RETRYABLE, RESPONSE_PERMANENT, RESPONSE_FATAL = 'ok', 'retryable', 'permanent', 'fatal'
+PERMANENT_STATUS_CODES = (404, 410)
+RETRYABLE_STATUS_CODES = (408, 425, 429)
 
-def download_file(file_url: str, filepath: str, session=None) -> None:
-    """Сохраняет в указанном каталоге файл из интернета."""
-    # if os.path.exists(filepath):
-    #     os.remove(filepath)  # OLD WAY WAS TO REMOVE IT
 
-    # if not os.path.exists(filepath):
+def download_file(file_url: str, filepath: str, session=None) -> None:
+    """
+    Сохраняет в указанном каталоге файл из интернета.
+    Файл пишется по частям во временный файл <filepath>.part и переименовывается
+    в filepath только после полной загрузки, поэтому filepath никогда не бывает
+    обрезанным. Оставшийся от прерванной загрузки .part докачивается через Range
+    с If-Range: рядом с .part хранится ETag или Last-Modified ответа, и если файл
+    на сервере с тех пор изменился, сервер присылает его целиком. Если сохранить
+    было нечего, .part не докачивается, а загружается заново.
+    """
     url = file_url.replace('\\', '/')
-    response = get_html_page(url, session=session)
+    part_filepath = filepath + PARTIAL_DOWNLOAD_SUFFIX
+    validator_filepath = part_filepath + VALIDATOR_SUFFIX
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    for attempt in range(CONNECTION_ATTEMPTS_COUNT):
+        except_text = f"Попытка {attempt + 1} из {CONNECTION_ATTEMPTS_COUNT}.\n"
+        downloaded_size = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+        validator = read_validator(validator_filepath) if downloaded_size else None
+        headers = {'Range': f'bytes={downloaded_size}-', 'If-Range': validator} if validator else None
+
+        try:
+            response = get_html_page(url, headers=headers, session=session, stream=True, use_cache=False)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None:
+                e.response.close()
+            if not (validator and e.response is not None and e.response.status_code == 416):
+                raise
+            # Продолжения нет: либо файл уже скачан целиком, либо он изменился на сервере
+            if get_content_range(e.response)[2] == downloaded_size:
+                os.replace(part_filepath, filepath)
+                remove_file(validator_filepath)
+                return
+            os.remove(part_filepath)
+            continue
+
+        with response:
+            start, end, expected_size = get_content_range(response)
+            if validator and response.status_code == 206 and start == downloaded_size:
+                file_mode = 'ab'
+            else:
+                file_mode = 'wb'
+                expected_size = None
+                if 'Content-Encoding' not in response.headers:
+                    with suppress(TypeError, ValueError):
+                        expected_size = int(response.headers.get('Content-Length'))
+                write_validator(validator_filepath, get_validator(response))
+
+            try:
+                with open(part_filepath, file_mode) as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                logger.debug(except_text + f"Разрыв во время загрузки файла, будет докачан. URL: {url}. Ошибка: {e}")
+                if not retry_budget.spend():
+                    break
+                continue
+
+        actual_size = os.path.getsize(part_filepath)
+        if expected_size is not None and actual_size != expected_size:
+            logger.debug(except_text + f"Размер файла {actual_size} вместо {expected_size} байт. URL: {url}")
+            if actual_size > expected_size:
+                os.remove(part_filepath)
+            if not retry_budget.spend():
+                break
+            continue
+
+        os.replace(part_filepath, filepath)
+        remove_file(validator_filepath)
+        return
+
+    raise Exception(f"ERROR: Не удалось загрузить файл ({CONNECTION_ATTEMPTS_COUNT} раз!). URL: {url}")
+
+
+def get_validator(response):
+    """
+    Возвращает значение для If-Range: сильный ETag ответа, а если его нет — Last-Modified.
+    Слабый ETag (W/...) для If-Range не годится. Если подходящего заголовка нет, возвращает None.
+    """
+    etag = response.headers.get('ETag', '').strip()
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified', '').strip() or None
 
-    # if session:
-    #     response = session.get(file_url.replace('\\', '/'))
-    # else:
-    #     response = requests.get(file_url.replace('\\', '/'))
-    # response.raise_for_status()
 
-    dirpath = os.path.dirname(filepath)
-    os.makedirs(dirpath, exist_ok=True)
-    with open(filepath, 'wb') as file:
-        file.write(response.content)
+def read_validator(validator_filepath: str):
+    """Читает сохранённое рядом с .part значение для If-Range или возвращает None."""
+    with suppress(OSError):
+        with open(validator_filepath, encoding='utf-8') as file:
+            return file.read().strip() or None
+    return None
+
+
+def write_validator(validator_filepath: str, validator) -> None:
+    """Сохраняет рядом с .part значение для If-Range (None — удаляет сохранённое)."""
+    if validator:
+        with open(validator_filepath, 'w', encoding='utf-8') as file:
+            file.write(validator)
+    else:
+        remove_file(validator_filepath)
+
+
+def remove_file(filepath: str) -> None:
+    """Удаляет файл, если он есть."""
+    with suppress(FileNotFoundError):
+        os.remove(filepath)
+
+
+def get_content_range(response):
+    """
+    Разбирает заголовок Content-Range вида 'bytes 100-199/1000' или 'bytes */1000'.
+    Возвращает (начало, конец, полный размер), неизвестные части — None.
+    """
+    start = end = total = None
+    content_range = response.headers.get('Content-Range', '')
+    match = re.fullmatch(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range.strip())
+    if match:
+        start, end, total = [int(value) if value and value.isdigit() else None for value in match.groups()]
+    return start, end, total
 
 
 def extract_filename_from_url(url: str) -> str:
@@ -47,95 +186,674 @@ def extract_filename_from_url(url: str) -> str:
     return filename
 
 
-def create_session_by_url(url, headers=None, yandex=False, verify_ssl=True):
-    """Создает сессию для доступа к сайту."""
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    __doc__ = 'Адаптер requests, включающий TCP keep-alive для соединений пула.'
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = KEEP_ALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+def create_pooled_session(pool_size=SESSION_POOL_SIZE, headers=None, yandex=False, verify_ssl=True):
+    """
+    Создаёт сессию с пулом на pool_size соединений к каждому хосту.
+    Размер пула должен быть не меньше числа потоков, одновременно работающих
+    с сессией, иначе лишние соединения закрываются и открываются заново.
+    """
     session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_connections=SESSION_POOL_HOSTS, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     session.verify = verify_ssl
     if yandex:
         session.headers = {'User-Agent': "Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)"}
     if headers:
         session.headers.update(headers)
+    return session
+
+
+def create_session_by_url(url, headers=None, yandex=False, verify_ssl=True, pool_size=SESSION_POOL_SIZE,
+                          cookies_filepath=None):
+    """
+    Создает сессию для доступа к сайту.
+    Если задан cookies_filepath, cookies берутся из этого файла и сохраняются в него же,
+    а прогрев сессии пропускается, пока для сайта есть действующие постоянные cookies.
+    """
+    session = create_pooled_session(pool_size, headers=headers, yandex=yandex, verify_ssl=verify_ssl)
+    if cookies_filepath:
+        session.cookies = load_cookies(cookies_filepath)
 
-    get_html_page(url, session=session)
+    if not has_site_cookies(session.cookies, url):
+        warm_up_session(session, url)
+        save_session_cookies(session)
 
     return session
 
 
-def exponential_backoff(attempt):
+def warm_up_session(session, url) -> None:
+    """
+    Получает cookies сайта дешёвым запросом HEAD. Если сайт HEAD не поддерживает,
+    делает обычный запрос, но не скачивает тело ответа.
+    """
+    if http_mode == MODE_REPLAY:
+        return
+
+    with suppress(requests.exceptions.RequestException):
+        rate_limiter = get_rate_limiter(url)
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = session.head(url, timeout=MAX_TIMEOUT, allow_redirects=True)
+        if classify_response(response) == RESPONSE_OK:
+            return
+
+    # Кэш не используется: запрос нужен ради cookies сайта
+    response = get_html_page(url, session=session, use_cache=False, stream=True)
+    response.close()
+
+
+def load_cookies(cookies_filepath: str) -> http.cookiejar.LWPCookieJar:
+    """Загружает cookies, сохранённые прошлым запуском программы."""
+    cookies = http.cookiejar.LWPCookieJar(cookies_filepath)
+    with suppress(OSError, http.cookiejar.LoadError):
+        cookies.load(ignore_discard=True)
+    return cookies
+
+
+def save_session_cookies(session) -> None:
+    """Сохраняет cookies сессии в файл, если сессия создана с cookies_filepath."""
+    cookies = session.cookies
+    if isinstance(cookies, http.cookiejar.FileCookieJar) and cookies.filename:
+        os.makedirs(os.path.dirname(cookies.filename), exist_ok=True)
+        cookies.save(ignore_discard=True)
+
+
+def has_site_cookies(cookies, url) -> bool:
+    """
+    Проверяет, есть ли в cookies действующие постоянные cookies для сайта url.
+    Сессионные cookies (без срока действия, например PHPSESSID) сохраняются в файл,
+    но сайт мог давно забыть такую сессию, поэтому они не в счёт.
+    """
+    host = urlsplit(url).hostname or ''
+    now = time.time()
+    for cookie in cookies:
+        domain = cookie.domain.lstrip('.')
+        if not (host == domain or host.endswith('.' + domain)):
+            continue
+        if not cookie.discard and cookie.expires is not None and cookie.expires > now:
+            return True
+    return False
+
+
+_shop_sessions = {}
+_shop_sessions_lock = threading.Lock()
+
+
+def get_shop_session(url, pool_size=SESSION_POOL_SIZE, headers=None, yandex=False, verify_ssl=True,
+                     cookies_filepath=None):
+    """
+    Возвращает общую на весь сеанс программы сессию для сайта url.
+    Сессия создаётся при первом обращении и переиспользуется всеми
+    издательствами магазина. Если нужен пул больше прежнего, он пересоздаётся.
+    """
+    session_key = (urlsplit(url).hostname, verify_ssl)
+    with _shop_sessions_lock:
+        session = _shop_sessions.get(session_key)
+        if session is None:
+            session = create_session_by_url(url, headers=headers, yandex=yandex, verify_ssl=verify_ssl,
+                                            pool_size=pool_size, cookies_filepath=cookies_filepath)
+            _shop_sessions[session_key] = session
+        elif session.get_adapter(url)._pool_maxsize < pool_size:
+            adapter = PooledHTTPAdapter(pool_connections=SESSION_POOL_HOSTS, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+
+def get_pool_stats(session) -> dict:
+    """
+    Собирает статистику пулов соединений сессии по хостам:
+    сколько соединений открыто за всё время, сколько сделано запросов
+    и сколько соединений сейчас простаивает в пуле.
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            stats[pool.host] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': sum(1 for connection in pool.pool.queue if connection) if pool.pool else 0,
+            }
+    return stats
+
+
+class RetryBudget:
+    __doc__ = 'Общий на весь запуск запас повторных попыток запросов.'
+
+    def __init__(self, retries=RETRY_BUDGET):
+        self._lock = threading.Lock()
+        self.retries_left = retries
+
+    def reset(self, retries=RETRY_BUDGET):
+        """Восстанавливает запас повторных попыток перед новым запуском."""
+        with self._lock:
+            self.retries_left = retries
+
+    def spend(self) -> bool:
+        """Забирает одну повторную попытку. Возвращает False, если запас исчерпан."""
+        with self._lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            return True
+
+
+retry_budget = RetryBudget()
+
+
+class TokenBucket:
+    __doc__ = '''
+    Ограничитель частоты запросов к одному сайту («ведро с токенами»).
+    Ведро наполняется со скоростью rate токенов в секунду до burst токенов,
+    каждый запрос забирает один токен и ждёт только тогда, когда ведро пусто.
+    '''
+
+    def __init__(self, rate, burst):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+
+    def configure(self, rate, burst):
+        """Меняет скорость и размер ведра на ходу."""
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self._tokens = min(self._tokens, burst)
+
+    def acquire(self):
+        """Забирает токен, при необходимости дожидаясь его появления."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Токен резервируется сразу, поэтому ожидающие потоки встают в очередь друг за другом
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+rate_limits = {}
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def find_host_domain(settings: dict, host: str):
+    """Ищет домен из настроек, к которому относится хост (например, api.my-shop.ru → my-shop.ru)."""
+    for domain in list(settings):
+        if host == domain or host.endswith('.' + domain):
+            return domain
+    return None
+
+
+def find_host_setting(settings: dict, host: str):
+    """Ищет настройку для хоста по его домену (например, api.my-shop.ru → my-shop.ru)."""
+    domain = find_host_domain(settings, host)
+    return None if domain is None else settings.get(domain)
+
+
+def set_rate_limit(domain: str, requests_per_second: float, burst: int) -> None:
+    """Задаёт допустимую частоту запросов и размер всплеска, общие для всех хостов домена."""
+    with _rate_limiters_lock:
+        rate_limits[domain] = (requests_per_second, burst)
+        if domain in _rate_limiters:
+            _rate_limiters[domain].configure(requests_per_second, burst)
+
+
+def get_rate_limiter(url: str):
+    """
+    Возвращает общий для всех потоков ограничитель частоты или None.
+    Ограничитель один на домен из set_rate_limit, поэтому все поддомены
+    (api., static2. и т. п.) делят одну допустимую частоту запросов.
+    """
+    domain = find_host_domain(rate_limits, urlsplit(url).hostname or '')
+    if domain is None:
+        return None
+    with _rate_limiters_lock:
+        if domain not in _rate_limiters:
+            _rate_limiters[domain] = TokenBucket(*rate_limits[domain])
+        return _rate_limiters[domain]
+
+
+def classify_response(response) -> str:
+    """
+    Относит ответ сервера к одному из классов:
+       — RESPONSE_OK — ответ получен (коды 1xx–3xx),
+       — RESPONSE_PERMANENT — страницы нет и не будет (404, 410),
+       — RESPONSE_RETRYABLE — временный сбой, стоит повторить (408, 425, 429, 5xx),
+       — RESPONSE_FATAL — остальные ошибки клиента, повтор не поможет.
+    """
+    status_code = response.status_code
+    if status_code < 400:
+        return RESPONSE_OK
+    if status_code in PERMANENT_STATUS_CODES:
+        return RESPONSE_PERMANENT
+    if status_code in RETRYABLE_STATUS_CODES or status_code >= 500:
+        return RESPONSE_RETRYABLE
+    return RESPONSE_FATAL
+
+
+def get_retry_after(response):
+    """Возвращает задержку в секундах из заголовка Retry-After или None."""
+    retry_after = response.headers.get('Retry-After', '').strip()
+    if not retry_after:
+        return None
+    if retry_after.isdigit():
+        return int(retry_after)
+    with suppress(TypeError, ValueError, IndexError):
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_date.timestamp() - time.time())
+    return None
+
+
+def exponential_backoff(attempt, deadline_at=None, retry_after=None) -> bool:
+    """
+    Ждёт перед повторной попыткой. Если сервер прислал Retry-After, ждёт столько,
+    сколько он просит. Возвращает False без ожидания, если ожидание выходит
+    за срок запроса deadline_at (по time.monotonic()).
+    """
     # Экспоненциальная задержка
-    delay = 2 ** (attempt + 1)  # 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048
-    delay += DELAY_BETWEEN_CONNECTION_ATTEMPTS
+    delay = 2 ** (attempt + 1)  # 2, 4, 8, 16, 32, 64, 128, ...
+    delay = min(delay + DELAY_BETWEEN_CONNECTION_ATTEMPTS, MAX_BACKOFF_DELAY)
+    if retry_after is not None:
+        delay = retry_after
+
+    if deadline_at is not None and time.monotonic() + delay > deadline_at:
+        return False
+
     time.sleep(delay)
+    return True
+
+
+def configure_http_mode(mode: str, fixtures_dirpath: str = None, latency=None) -> None:
+    """
+    Переключает сетевой режим программы:
+       — MODE_OFF — обычная работа с сайтами,
+       — MODE_RECORD — ответы сайтов дополнительно сохраняются в fixtures_dirpath,
+       — MODE_REPLAY — запросы в сеть не уходят, ответы берутся из fixtures_dirpath
+         с задержкой latency секунд (по умолчанию — как при записи).
+    """
+    global http_mode, fixture_store
+    http_mode = mode
+    fixture_store = FixtureStore(fixtures_dirpath, latency) if mode != MODE_OFF else None
 
 
-def get_html_page(url, headers=None, params=None, session=None, with_soup=False):
-    """Получает web-страницу с заданным url."""
+def send_request(url, headers=None, params=None, session=None, stream=False):
+    """Выполняет один GET-запрос с учётом режима записи/воспроизведения."""
+    if http_mode == MODE_REPLAY:
+        return fixture_store.replay(url, params, headers)
+
+    if session:
+        response = session.get(url, headers=headers, params=params, timeout=MAX_TIMEOUT, stream=stream)
+    else:
+        response = requests.get(url, headers=headers, params=params, timeout=MAX_TIMEOUT, stream=stream)
+
+    if http_mode == MODE_RECORD:
+        fixture_store.record(url, params, headers, response)
+    return response
+
+
+def enable_http_cache(db_filepath: str, ttl=None, max_size=None) -> None:
+    """Включает дисковый кэш ответов для get_html_page."""
+    global http_cache
+    cache_settings = {name: value for name, value in (('ttl', ttl), ('max_size', max_size)) if value is not None}
+    http_cache = HttpCache(db_filepath, **cache_settings)
+
+
+def get_html_page(url, headers=None, params=None, session=None, with_soup=False, deadline=REQUEST_DEADLINE,
+                  use_cache=True, stream=False, parser='html.parser', parse_only=None):
+    """
+    Получает web-страницу с заданным url.
+    При 404/410 и других ошибках клиента сразу выбрасывает requests.exceptions.HTTPError,
+    временные сбои повторяет, пока не кончатся попытки, срок deadline (в секундах)
+    или общий запас повторов retry_budget.
+    Если включён кэш (enable_http_cache) и use_cache, свежие ответы берутся из кэша,
+    а устаревшие перепроверяются условным запросом.
+    При stream=True тело ответа не читается сразу (см. requests stream).
+    parser и parse_only передаются в get_soup_from_content при with_soup=True.
+    """
     # by default, verify_ssl is True
     response = None
+    response_class = None
 
     heads = headers or session.headers if session else None
     parms = params or session.params if session else None
 
+    cache_key = cache_entry = None
+    if http_cache and use_cache and not stream:
+        cache_key = http_cache.make_key(url, params)
+        cache_entry = http_cache.get(cache_key)
+        if cache_entry and http_cache.is_fresh(cache_entry):
+            logger.debug(f"Страница взята из кэша. URL: {url}")
+            return _make_page_result(http_cache.to_response(cache_entry), with_soup, parser, parse_only)
+        if cache_entry:
+            headers = {**(headers or {}), **http_cache.get_conditional_headers(cache_entry)}
+    deadline_at = time.monotonic() + deadline
+    rate_limiter = get_rate_limiter(url)
+    controller = find_host_setting(concurrency_controllers, urlsplit(url).hostname or '')
+
     for attempt in range(CONNECTION_ATTEMPTS_COUNT):
         # logger.debug(f"Попытка {attempt + 1} из {CONNECTION_ATTEMPTS_COUNT}. URL: {url}"
         #              f", headers: {headers}, params: {params}, session: {session}"
         #              f", with_soup: {with_soup}")
-        # if attempt >= 1:
-        #     verify_ssl = False  # after first attempt, we don't need to verify SSL
 
         except_text = f"Попытка {attempt + 1} из {CONNECTION_ATTEMPTS_COUNT}.\n"
+        response_class = retry_after = None
         try:
-            if session:
-                response = session.get(url, params=params, timeout=MAX_TIMEOUT)
-            else:
-                response = requests.get(url, headers=headers, params=params, timeout=MAX_TIMEOUT)
+            if rate_limiter:
+                rate_limiter.acquire()
 
-            if response.status_code == 404:
-                logger.debug(except_text + f"Ошибка 404: Страница не найдена. URL: {url}")
-                # if not ignore_404_error:
-                exponential_backoff(attempt)
-                # continue
+            started_at = time.monotonic()
+            response = send_request(url, headers=headers, params=params, session=session, stream=stream)
 
-            if response:
+            response_class = classify_response(response)
+            if controller:
+                if response_class == RESPONSE_RETRYABLE:
+                    controller.record_failure()
+                else:
+                    controller.record_success(time.monotonic() - started_at)
+            if response_class == RESPONSE_OK:
                 break
+            elif response_class == RESPONSE_PERMANENT:
+                logger.debug(except_text + f"Ошибка {response.status_code}: Страница не найдена. URL: {url}")
+                raise_for_status(response, stream)
+            elif response_class == RESPONSE_FATAL:
+                logger.debug(except_text + f"Ошибка {response.status_code}: Сервер отклонил запрос. URL: {url}")
+                raise_for_status(response, stream)
+
+            logger.debug(except_text + f"Ошибка {response.status_code}: Временный сбой сервера. URL: {url}")
+            retry_after = get_retry_after(response)
+            if stream:
+                response.close()
+        except requests.exceptions.HTTPError:
+            raise
+        except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                requests.exceptions.InvalidSchema) as e:
+            logger.debug(except_text + f"Неверный адрес запроса. URL: {url}. Ошибка: {e}")
+            raise
         except requests.exceptions.ConnectionError:
             logger.debug(except_text + f"Ошибка соединения. URL: {url}")
-            exponential_backoff(attempt)
+            if controller:
+                controller.record_failure()
         except requests.exceptions.Timeout:
             logger.debug(except_text + f"Превышен таймаут. URL: {url}")
-            exponential_backoff(attempt)
+            if controller:
+                controller.record_failure()
         except requests.exceptions.ChunkedEncodingError:
             logger.debug(except_text + f"Разрыв в передаче данных. URL: {url}")
-            exponential_backoff(attempt)
+            if controller:
+                controller.record_failure()
         except requests.exceptions.RequestException as e:
             logger.debug(except_text + f"Ошибка запроса. URL: {url}. Ошибка: {e}")
-            exponential_backoff(attempt)
         except Exception as e:
             err_text = f"Неизвестная ошибка доступа к сайту. \n" \
                        f"URL: {url}, headers: {heads}, params: {parms}, session: {session}\n"
             if response:
                 err_text += f"response, content, request - {response, response.content, response.request}"
             logger.debug(err_text)
-            exponential_backoff(attempt)
-    else:
-        err_text = f"ERROR: Ошибка во время доступа к серверу. ({CONNECTION_ATTEMPTS_COUNT} раз!) \n" \
+
+        if attempt + 1 == CONNECTION_ATTEMPTS_COUNT:
+            break
+        if not retry_budget.spend():
+            logger.debug(f"Исчерпан общий запас повторных попыток ({RETRY_BUDGET}). URL: {url}")
+            break
+        if not exponential_backoff(attempt, deadline_at, retry_after):
+            logger.debug(f"Истекает срок ожидания запроса ({deadline} с). URL: {url}")
+            break
+
+    if response_class != RESPONSE_OK:
+        err_text = f"ERROR: Ошибка во время доступа к серверу. ({attempt + 1} раз!) \n" \
                    f"URL: {url}, headers: {heads}, params: {parms}, session: {session}\n"
-        if response:
+        if response is not None:
             err_text += f"response, content, request - {response, response.content, response.request}"
         logger.debug(err_text)
 
-        if response:
-            response.raise_for_status()
+        if response is not None:
+            raise_for_status(response, stream)
 
         raise Exception(err_text)
 
+    if cache_key:
+        if response.status_code == 304 and cache_entry:
+            http_cache.revalidate(cache_key, response)
+            logger.debug(f"Страница не изменилась, взята из кэша. URL: {url}")
+            response = http_cache.to_response(cache_entry)
+        else:
+            http_cache.store(cache_key, response)
+
+    return _make_page_result(response, with_soup, parser, parse_only)
+
+
+def raise_for_status(response, stream=False) -> None:
+    """
+    Выбрасывает HTTPError для ответа с ошибкой. Непрочитанный потоковый ответ
+    сначала дочитывается и закрывается, чтобы соединение вернулось в пул.
+    """
+    if stream:
+        with suppress(requests.exceptions.RequestException):
+            response.content
+        response.close()
+    response.raise_for_status()
+
+
+def _make_page_result(response, with_soup, parser, parse_only):
     if with_soup:
-        return response, get_soup_from_content(response.content)
+        return response, get_soup_from_content(response.content, parser, parse_only)
     else:
         return response
 
 
-def get_soup_from_content(content, parser='html.parser'):
-    """Получает объект BeautifulSoup из HTML-контента."""
+def get_soup_from_content(content, parser='html.parser', parse_only=None):
+    """
+    Получает объект BeautifulSoup из HTML-контента.
+    Быстрый режим — parser=FAST_HTML_PARSER и parse_only=make_class_strainer(...):
+    тогда lxml строит дерево только для нужных блоков страницы.
+    """
     encoded_content = content.encode('utf-8') if isinstance(content, str) else content
-    return BeautifulSoup(encoded_content, parser)
+    started_at = time.perf_counter()
+    soup = BeautifulSoup(encoded_content, parser, parse_only=parse_only)
+    parse_stats.add(time.perf_counter() - started_at)
+    return soup
+
+
+def make_class_strainer(*class_names) -> SoupStrainer:
+    """Создаёт фильтр, оставляющий при разборе только блоки с указанными CSS-классами."""
+    return SoupStrainer(class_=list(class_names))
+
+
+class ParseStats:
+    __doc__ = 'Счётчик числа и суммарного времени разборов HTML во всех потоках.'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self.count = 0
+            self.seconds = 0.0
+
+    def __str__(self):
+        return f"{self.count} разборов HTML за {self.seconds:.2f} с"
+
+
+parse_stats = ParseStats()
+
+
+class ConcurrencyController:
+    __doc__ = '''
+    Адаптивный (AIMD) лимит одновременных запросов к одному магазину.
+    Пока ответы приходят без сбоев и задержка не растёт, лимит увеличивается
+    на единицу за каждые limit успешных запросов, но только если за это время
+    лимит был хотя бы раз занят целиком (record_saturation). Таймауты,
+    разрывы соединения, 429 и 5xx уменьшают лимит вдвое (не чаще раза
+    в DECREASE_COOLDOWN секунд).
+    '''
+
+    def __init__(self, initial_limit, min_limit=1, max_limit=MAX_IN_FLIGHT_REQUESTS):
+        self._lock = threading.Lock()
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, initial_limit)
+        self.limit = max(min_limit, initial_limit)
+        self._successes = 0
+        self._saturated = False
+        self._latency = None
+        self._base_latency = None
+        self._decreased_at = 0.0
+
+    def record_success(self, latency: float) -> None:
+        """Учитывает успешный запрос с временем ответа latency секунд."""
+        with self._lock:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += (latency - self._latency) * LATENCY_SMOOTHING
+            if self._base_latency is None or self._latency < self._base_latency:
+                self._base_latency = self._latency
+
+            # Задержка заметно выросла — сайт на пределе, лимит не увеличиваем
+            if self._latency > self._base_latency * LATENCY_TOLERANCE:
+                self._successes = 0
+                return
+
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                if self._saturated:
+                    self._saturated = False
+                    self.limit = min(self.limit + 1, self.max_limit)
+
+    def record_saturation(self) -> None:
+        """Учитывает, что одновременно выполняется столько запросов, сколько позволяет лимит."""
+        with self._lock:
+            self._saturated = True
+
+    def record_failure(self) -> None:
+        """Учитывает признак перегрузки сайта: таймаут, разрыв, 429 или 5xx."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased_at < DECREASE_COOLDOWN:
+                return
+            self._decreased_at = now
+            self._successes = 0
+            self.limit = max(self.min_limit, int(self.limit * DECREASE_FACTOR))
+
+
+concurrency_controllers = {}
+_concurrency_controllers_lock = threading.Lock()
+
+
+def get_concurrency_controller(domain: str, initial_limit: int, max_limit: int) -> ConcurrencyController:
+    """
+    Возвращает адаптивный лимит одновременных запросов для домена магазина.
+    Лимит живёт весь сеанс программы, поэтому при сборе всех издательств
+    каждое следующее издательство начинает с уже найденного значения.
+    """
+    with _concurrency_controllers_lock:
+        if domain not in concurrency_controllers:
+            concurrency_controllers[domain] = ConcurrencyController(initial_limit, max_limit=max_limit)
+        return concurrency_controllers[domain]
+
+
+class AsyncFetcher:
+    __doc__ = '''
+    Асинхронный движок загрузки страниц и файлов.
+
+    Корутины get_html_page/download_file выполняются в одном цикле событий,
+    а сами блокирующие запросы уходят в пул потоков. Одновременно в сети
+    находится не больше limit запросов: это либо постоянное max_in_flight,
+    либо текущее значение адаптивного лимита controller. Запросы сверх лимита
+    ждут в очереди, и каждое освободившееся место будит ровно одного из них.
+    '''
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT_REQUESTS, controller: ConcurrencyController = None):
+        self.controller = controller
+        self.max_in_flight = controller.max_limit if controller else max_in_flight
+        self._in_flight = 0
+        self._waiters = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='fetch')
+
+    @property
+    def limit(self) -> int:
+        """Текущее допустимое число одновременных запросов."""
+        return self.controller.limit if self.controller else self.max_in_flight
+
+    async def get_html_page(self, url, headers=None, params=None, session=None, with_soup=False,
+                            parser='html.parser', parse_only=None):
+        """Асинхронно получает web-страницу с заданным url."""
+        return await self._run_limited(get_html_page, url, headers=headers, params=params, session=session,
+                                       with_soup=with_soup, parser=parser, parse_only=parse_only)
+
+    async def download_file(self, file_url: str, filepath: str, session=None) -> None:
+        """Асинхронно сохраняет в указанном каталоге файл из интернета."""
+        await self._run_limited(download_file, file_url, filepath, session=session)
+
+    async def fetch_cover(self, cover_store, file_url: str, session=None) -> str:
+        """Асинхронно получает путь к картинке в хранилище обложек (см. covers.CoverStore.fetch)."""
+        return await self._run_limited(cover_store.fetch, file_url, session=session)
+
+    async def _run_limited(self, func, *args, **kwargs):
+        await self._acquire()
+        if self.controller and self._in_flight >= self.limit:
+            self.controller.record_saturation()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self._release()
+
+    async def _acquire(self):
+        """Занимает место среди одновременных запросов, если мест нет — встаёт в очередь."""
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Место передаёт освободивший его запрос (_wake_waiters)
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # Будится ровно столько ожидающих, сколько освободилось мест (лимит мог и вырасти)
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    def close(self):
+        """Останавливает пул потоков движка."""
+        self._executor.shutdown(wait=True)